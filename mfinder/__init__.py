@@ -2,11 +2,8 @@ import os
 import re
 import logging
 import logging.config
-import asyncio
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.engine import make_url
 
 load_dotenv()
 
@@ -17,6 +14,16 @@ APP_ID = os.environ.get("APP_ID", "")
 API_HASH = os.environ.get("API_HASH", "")
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 DB_URL = os.environ.get("DB_URL", "")
+# asyncpg takes ssl from connect_args and does not understand the libpq sslmode option
+ASYNC_DB_URL = (
+    make_url(DB_URL).set(drivername="postgresql+asyncpg").difference_update_query(["sslmode"])
+    if DB_URL
+    else DB_URL
+)
+# one connection pool shared by every db module
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
 OWNER_ID = int(os.environ.get("OWNER_ID", ""))
 ADMINS = [
     int(user) if id_pattern.search(user) else user
@@ -26,6 +33,31 @@ DB_CHANNELS = [
     int(ch) if id_pattern.search(ch) else ch
     for ch in os.environ.get("DB_CHANNELS", "").split()
 ]
+# search engine used for normal mode: "fts" (full-text), "trgm" (indexed substring) or "ilike" (substring fallback)
+SEARCH_ENGINE = os.environ.get("SEARCH_ENGINE", "fts").lower()
+FTS_CONFIG = os.environ.get("FTS_CONFIG", "simple")
+# search result cache, entries are dropped whenever files are saved or deleted
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", 1000))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", 300))
+# per-user search settings cache, written through by change_search_settings
+USER_SETTINGS_CACHE_SIZE = int(os.environ.get("USER_SETTINGS_CACHE_SIZE", 10000))
+USER_SETTINGS_CACHE_TTL = int(os.environ.get("USER_SETTINGS_CACHE_TTL", 3600))
+# seconds between ban list reloads, only needed when several bot processes share the database
+BAN_LIST_REFRESH = int(os.environ.get("BAN_LIST_REFRESH", 0))
+# search sessions hold the ordered result ids behind the page buttons of a result message
+SEARCH_SESSION_SIZE = int(os.environ.get("SEARCH_SESSION_SIZE", 1000))
+SEARCH_SESSION_TTL = int(os.environ.get("SEARCH_SESSION_TTL", 900))
+SEARCH_SESSION_RESULTS = int(os.environ.get("SEARCH_SESSION_RESULTS", 500))
+# spelling suggestions for searches without results
+SPELL_MAX_DISTANCE = int(os.environ.get("SPELL_MAX_DISTANCE", 2))
+SPELL_PREFIX_LENGTH = int(os.environ.get("SPELL_PREFIX_LENGTH", 6))
+# channels indexed at the same time, further /index jobs wait for a free slot
+INDEX_CONCURRENCY = int(os.environ.get("INDEX_CONCURRENCY", 2))
+# live indexing of DB_CHANNELS: seconds a new post waits before it is saved,
+# posts saved per batch and posts held in memory while the database is down
+LIVE_INDEX_DELAY = float(os.environ.get("LIVE_INDEX_DELAY", 5))
+LIVE_INDEX_BATCH = int(os.environ.get("LIVE_INDEX_BATCH", 100))
+LIVE_INDEX_MAX_PENDING = int(os.environ.get("LIVE_INDEX_MAX_PENDING", 5000))
 
 try:
     import const
@@ -41,39 +73,3 @@ HELP_KB = const.HELP_KB
 logging.config.fileConfig(fname="config.ini", disable_existing_loggers=False)
 LOGGER = logging.getLogger(__name__)
 logging.getLogger("pyrogram").setLevel(logging.WARNING)
-
-# Database connection
-def start():
-    engine = create_engine(
-        DB_URL,
-        connect_args={"sslmode": "require"},
-        poolclass=QueuePool,
-        pool_size=10,
-        max_overflow=20,
-        pool_pre_ping=True,
-        pool_recycle=1800  # Recycle connections every 1800 seconds (30 minutes)
-    )
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
-
-SESSION = start()
-
-# Keep-alive task
-async def keep_alive():
-    while True:
-        try:
-            # Execute a simple query to keep the connection alive
-            with SESSION() as session:
-                session.execute("SELECT 1")
-            await asyncio.sleep(180)  # Sleep for 3 minutes
-        except Exception as e:
-            LOGGER.warning(f"Keep-alive error: {e}")
-            await asyncio.sleep(10)  # Wait before retrying
-
-# Main function
-async def main():
-    # Start the keep-alive task
-    asyncio.create_task(keep_alive())
-    # Your existing bot initialization and running code
-
-if __name__ == "__main__":
-    asyncio.run(main())
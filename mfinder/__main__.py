@@ -2,7 +2,11 @@ import uvloop
 from pyrogram import Client, idle, __version__
 from pyrogram.raw.all import layer
 from mfinder import APP_ID, API_HASH, BOT_TOKEN
+from mfinder.db.files_sql import load_spelling_vocabulary, load_known_files
+from mfinder.db.ban_sql import sync_ban_list
+from mfinder.utils.indexer import LIVE_INDEX
 import os
+import sys
 from flask import Flask
 from threading import Thread
 import asyncio
@@ -24,7 +28,12 @@ async def main():
         print(
             f"{me.first_name} - @{me.username} - Pyrogram v{__version__} (Layer {layer}) - Started..."
         )
+        asyncio.create_task(load_spelling_vocabulary())
+        asyncio.create_task(load_known_files())
+        asyncio.create_task(sync_ban_list())
         await idle()
+        # Save live indexed posts still waiting in the buffer
+        await LIVE_INDEX.close()
         print(f"{me.first_name} - @{me.username} - Stopped !!!")
 
 # Dummy port code for Render deployment
@@ -36,6 +45,13 @@ def home():
     return "Bot is running!"
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["migrate"]:
+        # python -m mfinder migrate: update the database schema and exit
+        from mfinder.db.migrations import migrate
+
+        migrate()
+        sys.exit()
+
     # Run the Flask server in a separate thread
     Thread(target=lambda: server.run(host="0.0.0.0", port=PORT)).start()
 
@@ -1,14 +1,9 @@
-import threading
-from sqlalchemy import create_engine, Column, BigInteger
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+import asyncio
+from sqlalchemy import select, delete, Column, BigInteger
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.pool import QueuePool
-from mfinder import DB_URL
-import time
-import sqlalchemy
-
-BASE = declarative_base()
+from mfinder import LOGGER, BAN_LIST_REFRESH
+from mfinder.db.database import BASE, SESSION, reconnect, is_disconnect
 
 class BanList(BASE):
     __tablename__ = "banlist"
@@ -17,72 +12,63 @@ class BanList(BASE):
     def __init__(self, user_id):
         self.user_id = user_id
 
-def start() -> scoped_session:
-    engine = create_engine(
-        DB_URL,
-        connect_args={"sslmode": "require"},
-        poolclass=QueuePool,
-        pool_size=10,
-        max_overflow=20,
-        pool_pre_ping=True,
-        pool_recycle=1800  # Recycle connections every 1800 seconds (30 minutes)
-    )
-    BASE.metadata.bind = engine
-    BASE.metadata.create_all(engine)
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
+# Held while the ban list is written or reloaded, so a reload can't undo a
+# ban or unban committed while it was reading the table
+INSERTION_LOCK = asyncio.Lock()
+
+# user ids of the banlist table once BANS_LOADED, checked on every search
+BANNED_USERS = set()
+BANS_LOADED = False
+
+async def load_ban_list():
+    global BANNED_USERS, BANS_LOADED
+    try:
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                BANNED_USERS = set((await session.scalars(select(BanList.user_id))).all())
+            BANS_LOADED = True
+        LOGGER.info("Ban list loaded with %s users", len(BANNED_USERS))
+    except Exception as e:
+        LOGGER.warning("Error occurred while loading ban list: %s", str(e))
 
-SESSION = start()
-INSERTION_LOCK = threading.RLock()
+async def sync_ban_list():
+    """Load the ban list, then reload it every BAN_LIST_REFRESH seconds if set,
+    picking up bans made by other bot processes on the same database."""
+    await load_ban_list()
+    while BAN_LIST_REFRESH > 0:
+        await asyncio.sleep(BAN_LIST_REFRESH)
+        await load_ban_list()
 
 async def ban_user(user_id):
-    with INSERTION_LOCK:
-        try:
-            usr = SESSION.query(BanList).filter_by(user_id=user_id).one()
-        except NoResultFound:
-            usr = BanList(user_id=user_id)
-            SESSION.add(usr)
-            SESSION.commit()
-            return True
-        except sqlalchemy.exc.OperationalError as e:
-            SESSION.rollback()
-            raise e
-        finally:
-            SESSION.close()
+    async with INSERTION_LOCK:
+        async with SESSION() as session:
+            await session.execute(insert(BanList).values(user_id=user_id).on_conflict_do_nothing())
+            await session.commit()
+        BANNED_USERS.add(user_id)
+    return True
 
 async def is_banned(user_id, retries=3):
-    with INSERTION_LOCK:
-        for attempt in range(retries):
-            try:
-                usr = SESSION.query(BanList).filter_by(user_id=user_id).one()
-                return usr.user_id
-            except NoResultFound:
-                return False
-            except sqlalchemy.exc.OperationalError as e:
-                if 'SSL connection has been closed unexpectedly' in str(e):
-                    if attempt < retries - 1:
-                        time.sleep(2)  # wait before retrying
-                        continue
-                raise e
-            except sqlalchemy.exc.PendingRollbackError:
-                SESSION.rollback()
-                if attempt < retries - 1:
-                    time.sleep(2)  # wait before retrying
-                    continue
-                raise
-            finally:
-                SESSION.close()
-
-async def unban_user(user_id):
-    with INSERTION_LOCK:
+    if BANS_LOADED:
+        return user_id if user_id in BANNED_USERS else False
+    # The ban list failed to load, ask the database
+    for attempt in range(retries):
         try:
-            usr = SESSION.query(BanList).filter_by(user_id=user_id).one()
-            SESSION.delete(usr)
-            SESSION.commit()
-            return True
+            async with SESSION() as session:
+                usr = (await session.execute(select(BanList).filter_by(user_id=user_id))).scalar_one()
+            return usr.user_id
         except NoResultFound:
             return False
-        except sqlalchemy.exc.OperationalError as e:
-            SESSION.rollback()
+        except Exception as e:
+            if is_disconnect(e) and attempt < retries - 1:
+                await asyncio.sleep(2)  # wait before retrying
+                await reconnect()
+                continue
             raise e
-        finally:
-            SESSION.close()
+
+async def unban_user(user_id):
+    async with INSERTION_LOCK:
+        async with SESSION() as session:
+            result = await session.execute(delete(BanList).where(BanList.user_id == user_id))
+            await session.commit()
+        BANNED_USERS.discard(user_id)
+    return result.rowcount > 0
@@ -1,12 +1,7 @@
-import threading
-from sqlalchemy import create_engine, Column, TEXT, BigInteger
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+import asyncio
+from sqlalchemy import select, Column, TEXT, BigInteger
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.pool import StaticPool
-from mfinder import DB_URL
-
-BASE = declarative_base()
+from mfinder.db.database import BASE, SESSION
 
 class Broadcast(BASE):
     __tablename__ = "broadcast"
@@ -17,68 +12,37 @@ class Broadcast(BASE):
         self.user_id = user_id
         self.user_name = user_name
 
-def start() -> scoped_session:
-    engine = create_engine(
-        DB_URL,
-        connect_args={"sslmode": "require"},
-        client_encoding="utf8",
-        poolclass=StaticPool,
-        pool_pre_ping=True  # Added to handle disconnections
-    )
-    BASE.metadata.bind = engine
-    BASE.metadata.create_all(engine)
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
-
-SESSION = start()
-INSERTION_LOCK = threading.RLock()
+# Only add_user takes it, so a user seen twice at once gets a single row
+INSERTION_LOCK = asyncio.Lock()
 
 async def add_user(user_id, user_name):
-    with INSERTION_LOCK:
-        try:
-            usr = SESSION.query(Broadcast).filter_by(user_id=user_id).one()
-        except NoResultFound:
-            usr = Broadcast(user_id=user_id, user_name=user_name)
-            SESSION.add(usr)
-            SESSION.commit()
-        except Exception as e:
-            SESSION.rollback()
-            raise e
-        finally:
-            SESSION.close()
+    async with INSERTION_LOCK:
+        async with SESSION() as session:
+            try:
+                usr = (await session.execute(select(Broadcast).filter_by(user_id=user_id))).scalar_one()
+            except NoResultFound:
+                usr = Broadcast(user_id=user_id, user_name=user_name)
+                session.add(usr)
+                await session.commit()
 
 async def is_user(user_id):
-    with INSERTION_LOCK:
+    async with SESSION() as session:
         try:
-            usr = SESSION.query(Broadcast).filter_by(user_id=user_id).one()
+            usr = (await session.execute(select(Broadcast).filter_by(user_id=user_id))).scalar_one()
             return usr.user_id
         except NoResultFound:
             return False
-        except Exception as e:
-            SESSION.rollback()
-            raise e
-        finally:
-            SESSION.close()
 
 async def query_msg():
-    try:
-        query = SESSION.query(Broadcast.user_id).order_by(Broadcast.user_id)
-        return query.all()
-    except Exception as e:
-        SESSION.rollback()
-        raise e
-    finally:
-        SESSION.close()
+    async with SESSION() as session:
+        query = select(Broadcast.user_id).order_by(Broadcast.user_id)
+        return (await session.execute(query)).all()
 
 async def del_user(user_id):
-    with INSERTION_LOCK:
+    async with SESSION() as session:
         try:
-            usr = SESSION.query(Broadcast).filter_by(user_id=user_id).one()
-            SESSION.delete(usr)
-            SESSION.commit()
+            usr = (await session.execute(select(Broadcast).filter_by(user_id=user_id))).scalar_one()
+            await session.delete(usr)
+            await session.commit()
         except NoResultFound:
             pass
-        except Exception as e:
-            SESSION.rollback()
-            raise e
-        finally:
-            SESSION.close()
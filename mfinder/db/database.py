@@ -0,0 +1,73 @@
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from mfinder import ASYNC_DB_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE
+
+# Declarative base of every table, so a single create_all covers them all
+BASE = declarative_base()
+
+_ENGINE = None
+_SESSION_FACTORY = None
+
+
+def get_engine():
+    """The one connection pool of the process, shared by all db modules.
+
+    Built on first use, importing a db module never touches the database.
+    """
+    global _ENGINE
+    if _ENGINE is None:
+        _ENGINE = create_async_engine(
+            ASYNC_DB_URL,
+            connect_args={"ssl": "require"},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    return _ENGINE
+
+
+def SESSION():
+    """Unit of work: `async with SESSION() as session:` checks a connection
+    out of the pool for the duration of the block."""
+    global _SESSION_FACTORY
+    if _SESSION_FACTORY is None:
+        _SESSION_FACTORY = async_sessionmaker(
+            bind=get_engine(), autoflush=False, expire_on_commit=False
+        )
+    return _SESSION_FACTORY()
+
+
+async def reconnect():
+    """Drop every pooled connection, the next checkout opens a fresh one."""
+    if _ENGINE is not None:
+        await _ENGINE.dispose()
+
+
+def is_disconnect(error):
+    """True if error means the connection to the database was lost, so a
+    reconnect and retry can help.
+
+    asyncpg never raises OperationalError: a dropped connection surfaces as a
+    DBAPIError flagged connection_invalidated, or as a plain socket error.
+    """
+    if isinstance(error, DBAPIError):
+        return error.connection_invalidated
+    return isinstance(error, OSError)
+
+
+def is_deadlock(error):
+    """True if Postgres aborted the transaction to break a deadlock, retrying it can succeed."""
+    return isinstance(error, DBAPIError) and getattr(error.orig, "sqlstate", None) == "40P01"
+
+
+def pool_stats():
+    pool = _ENGINE.pool if _ENGINE is not None else None
+    return {
+        "size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout() if pool else 0,
+        "checked_in": pool.checkedin() if pool else 0,
+        "overflow": max(pool.overflow(), 0) if pool else 0,
+    }
@@ -1,26 +1,39 @@
-import threading
-import time
-from sqlalchemy import create_engine, or_, func, and_
-from sqlalchemy import Column, TEXT, Numeric
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import QueuePool
-from sqlalchemy.exc import OperationalError, PendingRollbackError, NoResultFound
-from mfinder import DB_URL, LOGGER
-from mfinder.utils.helpers import unpack_new_file_id
+from sqlalchemy import or_, func, and_, cast, select, intersect, true, false
+from sqlalchemy import case, exists, literal, text, update
+from sqlalchemy import Column, TEXT, BigInteger, Float, Computed, Index, ForeignKey, literal_column
+from sqlalchemy.dialects.postgresql import TSVECTOR, REGCONFIG, insert
+from sqlalchemy.orm import deferred
+from mfinder import LOGGER, SEARCH_ENGINE, FTS_CONFIG, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+from mfinder.db.database import BASE, SESSION, get_engine, reconnect, is_disconnect, is_deadlock
+from mfinder.db.migrations import SEARCH_VECTOR_SQL
+from mfinder.utils.helpers import unpack_new_file_id, normalize, tokenize
+from mfinder.utils.cache import TTLCache
+from mfinder.utils.spelling import SPELLER
+from mfinder.utils.known_files import KNOWN_FILES
 import asyncio
 
-BASE = declarative_base()
-
 class Files(BASE):
     __tablename__ = "files"
-    file_name = Column(TEXT, primary_key=True)
-    file_id = Column(TEXT)
+    id = Column(BigInteger, primary_key=True)
+    file_name = Column(TEXT, nullable=False)
+    file_id = Column(TEXT, nullable=False)
     file_ref = Column(TEXT)
-    file_size = Column(Numeric)
+    file_size = Column(BigInteger)
     file_type = Column(TEXT)
     mime_type = Column(TEXT)
     caption = Column(TEXT)
+    # normalize()d file_name / caption, written once on save and only used for searching
+    search_name = deferred(Column(TEXT))
+    search_caption = deferred(Column(TEXT))
+    # Maintained by Postgres from search_name + search_caption, never loaded with the row
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
+
+    __table_args__ = (
+        # save_file's duplicate checks and get_file_details look files up by these
+        Index("ix_files_file_id", "file_id", unique=True),
+        Index("ix_files_file_name_file_size", "file_name", "file_size", unique=True),
+        Index("ix_files_search_vector", "search_vector", postgresql_using="gin"),
+    )
 
     def __init__(self, file_name, file_id, file_ref, file_size, file_type, mime_type, caption):
         self.file_name = file_name
@@ -30,186 +43,474 @@ class Files(BASE):
         self.file_type = file_type
         self.mime_type = mime_type
         self.caption = caption
+        self.search_name = normalize(file_name)
+        self.search_caption = normalize(caption)
 
-def start() -> scoped_session:
-    engine = create_engine(
-        DB_URL,
-        connect_args={"sslmode": "require"},
-        poolclass=QueuePool,
-        pool_size=10,
-        max_overflow=20,
-        pool_pre_ping=True,
-        pool_recycle=1800
+class FileTokens(BASE):
+    """Inverted index of the words in file_name and caption, used by precise search."""
+    __tablename__ = "file_tokens"
+    token = Column(TEXT, primary_key=True)
+    file_pk = Column(BigInteger, ForeignKey("files.id", ondelete="CASCADE"), primary_key=True)
+
+    __table_args__ = (
+        Index("ix_file_tokens_file_pk", "file_pk"),
     )
-    BASE.metadata.bind = engine
-    BASE.metadata.create_all(engine)
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
 
-SESSION = start()
-INSERTION_LOCK = threading.RLock()
+    def __init__(self, token, file_pk):
+        self.token = token
+        self.file_pk = file_pk
+
+class TermStats(BASE):
+    """Number of files containing each token, kept up to date by save_file / delete_file."""
+    __tablename__ = "term_stats"
+    token = Column(TEXT, primary_key=True)
+    doc_freq = Column(BigInteger, nullable=False, default=0)
+
+    def __init__(self, token, doc_freq=0):
+        self.token = token
+        self.doc_freq = doc_freq
+
+# (normalized query, precise, page, per_page) -> (files, total), cleared on every write to files
+SEARCH_CACHE = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+if SEARCH_ENGINE not in ("fts", "trgm", "ilike"):
+    LOGGER.warning("Unknown SEARCH_ENGINE %s, falling back to fts", SEARCH_ENGINE)
+
+def search_tokens(file_name, caption):
+    """Words of a file as stored in file_tokens."""
+    return tokenize(normalize(file_name)) | tokenize(normalize(caption))
+
+def ilike_condition(query):
+    """Every word must appear as a substring of the file name or caption."""
+    conditions = []
+    for word in normalize(query).split():
+        conditions.append(
+            or_(
+                Files.search_name.like(f"%{word}%"),
+                Files.search_caption.like(f"%{word}%"),
+            )
+        )
+    return and_(*conditions) if conditions else false()
+
+def fts_condition(query):
+    """Match the query against the GIN indexed search_vector column."""
+    tsquery = func.websearch_to_tsquery(cast(FTS_CONFIG, REGCONFIG), normalize(query))
+    return Files.search_vector.op("@@")(tsquery)
+
+def precise_condition(query):
+    """Every word must be a whole word of the file name or caption.
+
+    Each word is one lookup on the token index, the postings are intersected.
+    """
+    postings = [
+        select(FileTokens.file_pk).where(FileTokens.token == word)
+        for word in tokenize(normalize(query))
+    ]
+    if not postings:
+        return false()
+    if len(postings) == 1:
+        return Files.id.in_(postings[0])
+    return Files.id.in_(intersect(*postings))
+
+def search_condition(query):
+    """Build the filter for normal search mode using the configured SEARCH_ENGINE.
+
+    trgm and ilike share the substring filter, trgm just has pg_trgm indexes behind it.
+    """
+    if SEARCH_ENGINE in ("trgm", "ilike"):
+        return ilike_condition(query)
+    return fts_condition(query)
+
+def idf_weights(words):
+    """One row CTE with the BM25 idf of each word, as idf_0, idf_1, ...
+
+    Document frequencies come from term_stats and the file count from the
+    planner's estimate, both read by the search statement itself.
+    """
+    doc_freqs = [
+        func.coalesce(select(TermStats.doc_freq).where(TermStats.token == word).scalar_subquery(), 0)
+        for word in words
+    ]
+    file_count = literal_column("(SELECT reltuples FROM pg_class WHERE oid = 'files'::regclass)")
+    counts = select(
+        cast(func.greatest(file_count, *doc_freqs, 1), Float).label("total"),
+        *(cast(doc_freq, Float).label(f"df_{i}") for i, doc_freq in enumerate(doc_freqs)),
+    ).subquery("term_counts")
+    return select(
+        *(
+            func.ln(1 + (counts.c.total - counts.c[f"df_{i}"] + 0.5) / (counts.c[f"df_{i}"] + 0.5)).label(f"idf_{i}")
+            for i in range(len(words))
+        )
+    ).cte("weights")
+
+def rank_expression(query, weights=None):
+    """Relevance of a file for query, higher is better, and the weights CTE it reads.
+
+    Per query word: BM25 idf, full weight for a whole word hit in file_tokens
+    (half for a substring / stemmed hit) and a bonus that fades the later the
+    word appears in the file name.
+
+    Without weights the idfs are computed by the statement from a CTE, which
+    is returned to be joined and selected. With weights, the idfs an earlier
+    statement returned, the rank is rebuilt from them: every page of a
+    search then ranks a file the same, even after saves moved term_stats,
+    so the (rank, id) keyset cursor never skips or repeats a file.
+    """
+    words = sorted(tokenize(normalize(query)))
+    if not words:
+        return literal(0.0), None
+    if weights is None:
+        cte = idf_weights(words)
+        idfs = [cte.c[f"idf_{i}"] for i in range(len(words))]
+    else:
+        cte = None
+        idfs = [literal(idf, Float) for idf in weights]
+    rank = literal(0.0)
+    for word, idf in zip(words, idfs):
+        exact = exists().where(
+            FileTokens.token == word, FileTokens.file_pk == Files.id
+        )
+        position = func.strpos(Files.search_name, word)
+        rank = rank + (
+            idf
+            * case((exact, 1.0), else_=0.5)
+            * (1 + case((position > 0, 10.0 / (position + 9)), else_=0.0))
+        )
+    return rank, cte
+
+def ranked_select(condition, rank, weights, *columns):
+    """select(*columns, rank) of the files matching condition, joined with the weights CTE if any."""
+    query = select(*columns, rank.label("rank"))
+    if weights is not None:
+        query = query.add_columns(*weights.c).join_from(Files, weights, true())
+    return query.where(condition)
 
-def reconnect_session(max_retries=5, delay=5):
-    """Attempt to reconnect to the database a specified number of times with a delay."""
+def row_weights(row, weights):
+    """The idfs selected from the weights CTE, always the last columns of row."""
+    return tuple(row[-len(weights.c):]) if weights is not None else ()
+
+def search_cache_key(query, precise, page, per_page, weights=None, limit=0):
+    return (normalize(query), precise, page, per_page, weights, limit)
+
+async def fetch_page(session, condition, rank, weights, page, per_page, after=None, before=None):
+    """Return one page of files matching condition and the total match count.
+
+    Files are ordered by rank, best first, then by id. Every returned
+    file gets a sort_key (rank, id). after / before are the last /
+    first sort_key of the neighbouring page: with one of them the page is
+    found by seeking instead of skipping (page - 1) * per_page rows, so deep
+    pages cost the same as the first one. Either way the total comes back in
+    the same statement.
+    """
+    if after is None and before is None:
+        rows = (
+            await session.execute(
+                ranked_select(condition, rank, weights, Files, func.count().over().label("total"))
+                .order_by(rank.desc(), Files.id)
+                .offset((page - 1) * per_page)
+                .limit(per_page)
+            )
+        ).all()
+    else:
+        total = select(func.count()).select_from(Files).where(condition).scalar_subquery()
+        files_query = ranked_select(condition, rank, weights, Files, total.label("total"))
+        if after is not None:
+            after_rank, after_id = after
+            files_query = files_query.where(
+                or_(rank < after_rank, and_(rank == after_rank, Files.id > after_id))
+            ).order_by(rank.desc(), Files.id)
+        else:
+            before_rank, before_id = before
+            files_query = files_query.where(
+                or_(rank > before_rank, and_(rank == before_rank, Files.id < before_id))
+            ).order_by(rank, Files.id.desc())
+        rows = (await session.execute(files_query.limit(per_page))).all()
+        if before is not None:
+            rows.reverse()
+    if not rows:
+        return [], 0
+    files = []
+    for row in rows:
+        file = row[0]
+        file.sort_key = (row.rank, file.id)
+        files.append(file)
+    return files, rows[0].total
+
+async def fetch_ids(session, condition, rank, weights, limit, per_page):
+    """Return the first per_page matching files, the total, (primary key,
+    sort_key) of up to limit files in result order and the idfs the ranks
+    were computed with, all from one statement.
+
+    Only the first per_page ids are joined back to their files rows, the
+    others come back as ids alone.
+    """
+    ranked = (
+        ranked_select(
+            condition,
+            rank,
+            weights,
+            Files.id,
+            func.count().over().label("total"),
+            func.row_number().over(order_by=(rank.desc(), Files.id)).label("position"),
+        )
+        .order_by(rank.desc(), Files.id)
+        .limit(limit)
+        .subquery("ranked")
+    )
+    rows = (
+        await session.execute(
+            select(Files, ranked)
+            .outerjoin_from(ranked, Files, and_(Files.id == ranked.c.id, ranked.c.position <= per_page))
+            .order_by(ranked.c.position)
+        )
+    ).all()
+    if not rows:
+        return [], 0, [], ()
+    files = []
+    for row in rows:
+        file = row[0]
+        if file is not None:
+            file.sort_key = (row.rank, row.id)
+            files.append(file)
+    return (
+        files,
+        rows[0].total,
+        [(row.id, (row.rank, row.id)) for row in rows],
+        row_weights(rows[0], weights),
+    )
+
+async def reconnect_session(max_retries=5, delay=5):
+    """Drop the pooled connections and check the database is reachable again, retrying with a delay."""
     for attempt in range(max_retries):
         try:
-            global SESSION
-            SESSION = start()
+            await reconnect()
+            async with get_engine().connect() as conn:
+                await conn.execute(text("SELECT 1"))
             return SESSION
-        except OperationalError as e:
+        except Exception as e:
             LOGGER.warning(f"Database connection failed: {e}. Retrying in {delay} seconds...")
-            time.sleep(delay)
+            await asyncio.sleep(delay)
     raise Exception("Failed to reconnect to the database after multiple attempts")
 
-async def save_file(media):
-    """Save a media file to the database."""
+def file_row(media):
+    """Column values of the files row for a media, as save_files inserts them."""
     file_id, file_ref = unpack_new_file_id(media.file_id)
-    with INSERTION_LOCK:
-        try:
-            file = SESSION.query(Files).filter_by(file_id=file_id).one()
-            LOGGER.warning("%s is already saved in the database", media.file_name)
-        except NoResultFound:
-            try:
-                file = SESSION.query(Files).filter_by(file_name=media.file_name, file_size=media.file_size).one()
-                LOGGER.warning("%s with size %s is already saved in the database", media.file_name, media.file_size)
-            except NoResultFound:
-                file = Files(
-                    file_name=media.caption if media.caption else media.file_name,
-                    file_id=file_id,
-                    file_ref=file_ref,
-                    file_size=media.file_size,
-                    file_type=media.file_type,
-                    mime_type=media.mime_type,
-                    caption=media.caption if media.caption else media.file_name,
+    file_name = media.caption if media.caption else media.file_name
+    return {
+        "file_name": file_name,
+        "file_id": file_id,
+        "file_ref": file_ref,
+        "file_size": media.file_size,
+        "file_type": media.file_type,
+        "mime_type": media.mime_type,
+        "caption": file_name,
+        "search_name": normalize(file_name),
+        "search_caption": normalize(file_name),
+    }
+
+def after_save(rows, doc_freqs):
+    """Bring the in-memory search state up to date after files were saved.
+
+    rows are the saved files rows, doc_freqs maps each token to the number of
+    new files containing it.
+    """
+    for row in rows:
+        KNOWN_FILES.add(row["file_id"], row["file_name"], row["file_size"])
+    for token, count in doc_freqs.items():
+        SPELLER.add(token, count)
+    SEARCH_CACHE.clear()
+
+def after_delete(file, tokens):
+    """Bring the in-memory search state up to date after a file was deleted."""
+    KNOWN_FILES.discard(file.file_id, file.file_name, file.file_size)
+    for token in tokens:
+        SPELLER.remove(token)
+    SEARCH_CACHE.clear()
+
+async def insert_files(file_rows, max_params):
+    """Insert files rows and their tokens in one transaction, return the
+    (id, file_id, file_name, caption) of the inserted ones and their doc_freqs."""
+    async with SESSION() as session:
+        # asyncpg allows 32767 parameters per statement, every insert is
+        # split into chunks of as many rows as fit in max_params
+        chunk_size = max_params // len(file_rows[0])
+        inserted = []
+        for start in range(0, len(file_rows), chunk_size):
+            inserted += (
+                await session.execute(
+                    insert(Files)
+                    .values(file_rows[start:start + chunk_size])
+                    .on_conflict_do_nothing()
+                    .returning(Files.id, Files.file_id, Files.file_name, Files.caption)
                 )
-                LOGGER.info("%s is saved in the database", media.file_name)
-                SESSION.add(file)
-                SESSION.commit()
-                return True
-            except Exception as e:
-                LOGGER.warning("Error occurred while saving file in the database: %s", str(e))
-                SESSION.rollback()
-                return False
+            ).all()
+        doc_freqs = {}
+        token_rows = []
+        for file_pk, file_id, file_name, caption in inserted:
+            for token in search_tokens(file_name, caption):
+                doc_freqs[token] = doc_freqs.get(token, 0) + 1
+                token_rows.append({"token": token, "file_pk": file_pk})
+        # token and file_pk, or token and doc_freq: two parameters per row
+        chunk_size = max_params // 2
+        for start in range(0, len(token_rows), chunk_size):
+            await session.execute(insert(FileTokens).values(token_rows[start:start + chunk_size]))
+        # Sorted, so concurrent batches lock term_stats rows in the same order
+        stats_rows = [{"token": token, "doc_freq": doc_freqs[token]} for token in sorted(doc_freqs)]
+        for start in range(0, len(stats_rows), chunk_size):
+            stats = insert(TermStats).values(stats_rows[start:start + chunk_size])
+            await session.execute(
+                stats.on_conflict_do_update(
+                    index_elements=[TermStats.token],
+                    set_={"doc_freq": TermStats.doc_freq + stats.excluded.doc_freq},
+                )
+            )
+        await session.commit()
+    return inserted, doc_freqs
+
+async def save_files(batch, max_params=32767):
+    """Save a batch of media files to the database, skipping the ones already saved.
+
+    Files are deduplicated inside the batch first, then written with
+    INSERT ... ON CONFLICT DO NOTHING in one transaction: the unique indexes
+    on file_id and (file_name, file_size) decide what is a duplicate, so
+    concurrent saves need no lock. Rows go in file_id order so overlapping
+    batches lock them in the same order, a batch that still deadlocks is
+    tried once more. Files the in-memory KNOWN_FILES filter already knows
+    are counted as duplicates without a query.
+
+    Returns (saved, duplicates, skipped), lists of media from batch, skipped
+    being the files without a name or caption. Raises on a database error.
+    """
+    rows = {}
+    seen = set()
+    duplicates = []
+    skipped = []
+    for media in batch:
+        row = file_row(media)
+        if not row["file_name"]:
+            # Nothing to search for, and one NOT NULL violation would fail the whole batch
+            skipped.append(media)
+            continue
+        if KNOWN_FILES.known(row["file_id"], row["file_name"], row["file_size"]):
+            # Already saved, no need to ask the database
+            duplicates.append(media)
+            continue
+        keys = (row["file_id"], (row["file_name"], row["file_size"]))
+        if seen.intersection(keys):
+            duplicates.append(media)
+            continue
+        seen.update(keys)
+        rows[row["file_id"]] = (media, row)
+    if skipped:
+        LOGGER.info("Skipped %s files without a file name or caption", len(skipped))
+    if not rows:
+        return [], duplicates, skipped
+    file_rows = [row for _, (_, row) in sorted(rows.items())]
+    for attempt in range(2):
+        try:
+            inserted, doc_freqs = await insert_files(file_rows, max_params)
+            break
         except Exception as e:
-            LOGGER.warning("Error occurred while saving file in the database: %s", str(e))
-            SESSION.rollback()
-            return False
-        finally:
-            SESSION.close()
-
-async def get_filter_results(query, page=1, per_page=10):
-    """Get filtered results from the database."""
+            if attempt == 0 and is_deadlock(e):
+                LOGGER.warning("Deadlock while saving files, retrying: %s", str(e))
+                continue
+            LOGGER.warning("Error occurred while saving files in the database: %s", str(e))
+            raise
+    saved_ids = {file_id for _, file_id, _, _ in inserted}
+    saved = [media for file_id, (media, _) in rows.items() if file_id in saved_ids]
+    duplicates += [media for file_id, (media, _) in rows.items() if file_id not in saved_ids]
+    LOGGER.info("Saved %s files in the database, %s were already saved", len(saved), len(duplicates))
+    after_save([row for file_id, (_, row) in rows.items() if file_id in saved_ids], doc_freqs)
+    return saved, duplicates, skipped
+
+async def save_file(media):
+    """Save a media file to the database."""
+    try:
+        saved, duplicates, _ = await save_files([media])
+    except Exception:
+        return False
+    if duplicates:
+        LOGGER.warning("%s is already saved in the database", media.file_name)
+    return bool(saved)
+
+async def search_files(query, precise=False, page=1, per_page=10, after=None, before=None, weights=None, limit=0):
+    """Search files in normal or precise mode, best ranked first.
+
+    Returns (files, total, rows, weights): the files of page and the total
+    match count. With a limit the search starts a session: files is the
+    first page, rows the (id, sort_key) pairs of up to limit results and
+    weights the idfs of their ranks, all read by the same statement. Without
+    one rows is empty, and after / before / weights continue a session as
+    described in fetch_page and rank_expression.
+    """
+    # Only separators, e.g. "---": no words to search for, an empty condition would match every file
+    if not normalize(query):
+        return [], 0, [], ()
+    cache_key = search_cache_key(query, precise, page, per_page, weights, limit)
+    cached = SEARCH_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+    condition = precise_condition(query) if precise else search_condition(query)
     retries = 3
     while retries > 0:
         try:
-            with INSERTION_LOCK:
-                offset = (page - 1) * per_page
-                search = query.split()
-                conditions = []
-                for word in search:
-                    conditions.append(
-                        or_(
-                            Files.file_name.ilike(f"%{word}%"),
-                            Files.caption.ilike(f"%{word}%"),
-                        )
-                    )
-                combined_condition = and_(*conditions)
-                files_query = (
-                    SESSION.query(Files)
-                    .filter(combined_condition)
-                    .order_by(Files.file_name)
-                )
-                total_count = files_query.count()
-                files = files_query.offset(offset).limit(per_page).all()
-                return files, total_count
-        except PendingRollbackError:
-            SESSION.rollback()
-            retries -= 1
-            continue
-        except OperationalError as e:
-            LOGGER.warning(f"OperationalError: {e}. Retrying...")
-            reconnect_session()
-            retries -= 1
+            async with SESSION() as session:
+                rank, cte = rank_expression(query, weights)
+                if limit:
+                    results = await fetch_ids(session, condition, rank, cte, limit, per_page)
+                else:
+                    files, total = await fetch_page(session, condition, rank, cte, page, per_page, after, before)
+                    results = files, total, [], weights or ()
+            SEARCH_CACHE.set(cache_key, results)
+            return results
         except Exception as e:
-            LOGGER.warning(f"Error occurred while retrieving filter results: {e}")
-            return [], 0
-        finally:
-            try:
-                SESSION.close()
-            except Exception as close_error:
-                LOGGER.error(f"Error closing session: {close_error}")
-    return [], 0
-
-async def get_precise_filter_results(query, page=1, per_page=10):
-    """Get precise filtered results from the database."""
+            if not is_disconnect(e):
+                LOGGER.warning(f"Error occurred while retrieving filter results: {e}")
+                return [], 0, [], ()
+            LOGGER.warning(f"Database connection lost: {e}. Retrying...")
+            await reconnect_session()
+            retries -= 1
+    return [], 0, [], ()
+
+async def get_files_by_ids(ids):
+    """Get files by primary key, in the order of ids. Ids deleted meanwhile are skipped."""
+    if not ids:
+        return []
     retries = 3
     while retries > 0:
         try:
-            with INSERTION_LOCK:
-                offset = (page - 1) * per_page
-                search = query.split()
-                conditions = []
-                for word in search:
-                    conditions.append(
-                        or_(
-                            func.concat(" ", Files.file_name, " ").ilike(f"% {word} %"),
-                            func.concat(" ", Files.caption, " ").ilike(f"% {word} %"),
-                        )
-                    )
-                combined_condition = and_(*conditions)
-                files_query = (
-                    SESSION.query(Files)
-                    .filter(combined_condition)
-                    .order_by(Files.file_name)
-                )
-                total_count = files_query.count()
-                files = files_query.offset(offset).limit(per_page).all()
-                return files, total_count
-        except PendingRollbackError:
-            SESSION.rollback()
-            retries -= 1
-            continue
-        except OperationalError as e:
-            LOGGER.warning(f"OperationalError: {e}. Retrying...")
-            reconnect_session()
-            retries -= 1
+            async with SESSION() as session:
+                files = (await session.scalars(select(Files).where(Files.id.in_(ids)))).all()
+            by_id = {file.id: file for file in files}
+            return [by_id[file_id] for file_id in ids if file_id in by_id]
         except Exception as e:
-            LOGGER.warning(f"Error occurred while retrieving filter results: {e}")
-            return [], 0
-        finally:
-            try:
-                SESSION.close()
-            except Exception as close_error:
-                LOGGER.error(f"Error closing session: {close_error}")
-    return [], 0
+            if not is_disconnect(e):
+                LOGGER.warning(f"Error occurred while retrieving files: {e}")
+                return []
+            LOGGER.warning(f"Database connection lost: {e}. Retrying...")
+            await reconnect_session()
+            retries -= 1
+    return []
 
 async def get_file_details(file_id):
     """Get file details based on file_id and generate a download link."""
     retries = 3
     while retries > 0:
         try:
-            with INSERTION_LOCK:
-                file_details = SESSION.query(Files).filter_by(file_id=file_id).all()
-                if file_details:
-                    # Generate the direct download link
-                    download_link = f"https://yourserver.com/download/{file_id}"
-                    return file_details, download_link
+            async with SESSION() as session:
+                file_details = (await session.scalars(select(Files).filter_by(file_id=file_id))).all()
+            if file_details:
+                # Generate the direct download link
+                download_link = f"https://yourserver.com/download/{file_id}"
+                return file_details, download_link
+            return None, None
+        except Exception as e:
+            if not is_disconnect(e):
+                LOGGER.warning(f"Error occurred while retrieving file details: {e}")
                 return None, None
-        except PendingRollbackError:
-            SESSION.rollback()
-            retries -= 1
-            continue
-        except OperationalError as e:
-            LOGGER.warning(f"OperationalError: {e}. Retrying...")
-            reconnect_session()
+            LOGGER.warning(f"Database connection lost: {e}. Retrying...")
+            await reconnect_session()
             retries -= 1
-        except Exception as e:
-            LOGGER.warning(f"Error occurred while retrieving file details: {e}")
-            return None, None
-        finally:
-            try:
-                SESSION.close()
-            except Exception as close_error:
-                LOGGER.error(f"Error closing session: {close_error}")
     return None, None
 
 async def delete_file(media):
@@ -218,31 +519,29 @@ async def delete_file(media):
     retries = 3
     while retries > 0:
         try:
-            with INSERTION_LOCK:
-                file = SESSION.query(Files).filter_by(file_id=file_id).first()
-                if file:
-                    SESSION.delete(file)
-                    SESSION.commit()
-                    return True
-                return "Not Found"
-                LOGGER.warning("File to delete not found: %s", str(file_id))
-        except PendingRollbackError:
-            SESSION.rollback()
-            retries -= 1
-            continue
-        except OperationalError as e:
-            LOGGER.warning(f"OperationalError: {e}. Retrying...")
-            reconnect_session()
-            retries -= 1
+            async with SESSION() as session:
+                file = (await session.scalars(select(Files).filter_by(file_id=file_id))).first()
+                if not file:
+                    LOGGER.warning("File to delete not found: %s", str(file_id))
+                    return "Not Found"
+                tokens = search_tokens(file.file_name, file.caption)
+                await session.delete(file)
+                if tokens:
+                    await session.execute(
+                        update(TermStats)
+                        .where(TermStats.token.in_(tokens))
+                        .values(doc_freq=TermStats.doc_freq - 1)
+                    )
+                await session.commit()
+            after_delete(file, tokens)
+            return True
         except Exception as e:
-            LOGGER.warning(f"Error occurred while deleting file: {e}")
-            SESSION.rollback()
-            return False
-        finally:
-            try:
-                SESSION.close()
-            except Exception as close_error:
-                LOGGER.error(f"Error closing session: {close_error}")
+            if not is_disconnect(e):
+                LOGGER.warning(f"Error occurred while deleting file: {e}")
+                return False
+            LOGGER.warning(f"Database connection lost: {e}. Retrying...")
+            await reconnect_session()
+            retries -= 1
     return False
 
 async def count_files():
@@ -250,33 +549,63 @@ async def count_files():
     retries = 3
     while retries > 0:
         try:
-            with INSERTION_LOCK:
-                total_count = SESSION.query(Files).count()
-                return total_count
-        except PendingRollbackError:
-            SESSION.rollback()
-            retries -= 1
-            continue
-        except OperationalError as e:
-            LOGGER.warning(f"OperationalError: {e}. Retrying...")
-            reconnect_session()
-            retries -= 1
+            async with SESSION() as session:
+                return await session.scalar(select(func.count()).select_from(Files))
         except Exception as e:
-            LOGGER.warning(f"Error occurred while counting files: {e}")
-            return 0
-        finally:
-            try:
-                SESSION.close()
-            except Exception as close_error:
-                LOGGER.error(f"Error closing session: {close_error}")
+            if not is_disconnect(e):
+                LOGGER.warning(f"Error occurred while counting files: {e}")
+                return 0
+            LOGGER.warning(f"Database connection lost: {e}. Retrying...")
+            await reconnect_session()
+            retries -= 1
     return 0
 
+async def load_spelling_vocabulary():
+    """Fill the spelling corrector with every token and its file count from term_stats."""
+    try:
+        async with SESSION() as session:
+            terms = (
+                await session.execute(
+                    select(TermStats.token, TermStats.doc_freq).where(TermStats.doc_freq > 0)
+                )
+            ).all()
+    except Exception as e:
+        LOGGER.warning("Error occurred while loading spelling vocabulary: %s", str(e))
+        return
+    for count, (token, doc_freq) in enumerate(terms, 1):
+        SPELLER.add(token, doc_freq)
+        # Building the delete index is CPU bound, let updates through meanwhile
+        if count % 1000 == 0:
+            await asyncio.sleep(0)
+    LOGGER.info("Spelling vocabulary loaded with %s words", len(SPELLER))
+
+async def load_known_files(batch_size=10000):
+    """Fill the duplicate pre-filter with the keys of every saved file."""
+    count = 0
+    try:
+        async with SESSION() as session:
+            result = await session.stream(
+                select(Files.file_id, Files.file_name, Files.file_size).execution_options(yield_per=batch_size)
+            )
+            async for rows in result.partitions():
+                KNOWN_FILES.extend(rows)
+                count += len(rows)
+                # Hashing is CPU bound, let updates through meanwhile
+                await asyncio.sleep(0)
+    except Exception as e:
+        LOGGER.warning("Error occurred while loading known files: %s", str(e))
+        KNOWN_FILES.abort_loading()
+        return
+    KNOWN_FILES.finish_loading()
+    stats = KNOWN_FILES.stats()
+    LOGGER.info("Duplicate filter loaded with %s files in %s bytes", count, stats["memory"])
+
 async def keep_alive():
     """Keep the database connection alive."""
     while True:
         try:
-            with SESSION() as session:
-                session.execute("SELECT 1")
+            async with get_engine().connect() as conn:
+                await conn.execute(text("SELECT 1"))
             await asyncio.sleep(180)
         except Exception as e:
             LOGGER.warning(f"Keep-alive error: {e}")
@@ -0,0 +1,62 @@
+from sqlalchemy import select, func, Column, BigInteger, DateTime
+from sqlalchemy.dialects.postgresql import insert
+from mfinder import LOGGER
+from mfinder.db.database import BASE, SESSION
+
+class IndexCheckpoint(BASE):
+    """How far a channel has been indexed, so /index can resume or pick up only new posts."""
+    __tablename__ = "index_checkpoints"
+    chat_id = Column(BigInteger, primary_key=True)
+    # High-water mark: every message id up to this one has been saved
+    indexed_to = Column(BigInteger, nullable=False, default=0)
+    # Last message id of the most recent /index run, beyond indexed_to if it did not finish
+    last_msg_id = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __init__(self, chat_id, indexed_to=0, last_msg_id=0):
+        self.chat_id = chat_id
+        self.indexed_to = indexed_to
+        self.last_msg_id = last_msg_id
+
+async def get_checkpoint(chat_id):
+    try:
+        async with SESSION() as session:
+            return await session.get(IndexCheckpoint, chat_id)
+    except Exception as e:
+        LOGGER.warning("Error getting index checkpoint: %s", str(e))
+        return None
+
+async def set_checkpoint(chat_id, indexed_to, last_msg_id):
+    """Record indexing progress. Neither value ever moves backwards, so a
+    full reindex that is stopped early keeps the earlier high-water mark."""
+    stmt = insert(IndexCheckpoint).values(chat_id=chat_id, indexed_to=indexed_to, last_msg_id=last_msg_id)
+    try:
+        async with SESSION() as session:
+            await session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[IndexCheckpoint.chat_id],
+                    set_={
+                        "indexed_to": func.greatest(IndexCheckpoint.indexed_to, stmt.excluded.indexed_to),
+                        "last_msg_id": func.greatest(IndexCheckpoint.last_msg_id, stmt.excluded.last_msg_id),
+                        "updated_at": func.now(),
+                    },
+                )
+            )
+            await session.commit()
+    except Exception as e:
+        LOGGER.warning("Error saving index checkpoint: %s", str(e))
+
+async def unfinished_checkpoints():
+    """Checkpoints of runs that stopped before their last message."""
+    try:
+        async with SESSION() as session:
+            return (
+                await session.scalars(
+                    select(IndexCheckpoint)
+                    .where(IndexCheckpoint.indexed_to < IndexCheckpoint.last_msg_id)
+                    .order_by(IndexCheckpoint.updated_at.desc())
+                )
+            ).all()
+    except Exception as e:
+        LOGGER.warning("Error listing index checkpoints: %s", str(e))
+        return []
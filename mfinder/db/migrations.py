@@ -0,0 +1,244 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from mfinder import DB_URL, FTS_CONFIG, SEARCH_ENGINE, LOGGER
+from mfinder.utils.helpers import normalize
+
+SEARCH_VECTOR_SQL = (
+    f"to_tsvector('{FTS_CONFIG}'::regconfig, "
+    f"coalesce(search_name, '') || ' ' || coalesce(search_caption, ''))"
+)
+
+
+def create_tables(conn):
+    """Create every table that does not exist yet."""
+    # Imported here, the model modules import SEARCH_VECTOR_SQL from this one
+    from mfinder.db import files_sql, settings_sql, ban_sql, filters_sql, broadcast_sql, index_sql  # noqa: F401
+    from mfinder.db.database import BASE
+
+    BASE.metadata.create_all(conn)
+
+
+class Online(list):
+    """Migration steps run on an autocommit connection instead of one transaction.
+
+    Every statement commits on its own, so batched backfills and CREATE INDEX
+    CONCURRENTLY never hold a lock on the table for the whole migration. A
+    failed online migration is retried from the start, its steps must check
+    what is already done.
+    """
+
+
+def add_surrogate_key(conn, batch_size=5000):
+    """Move files from the file_name primary key to a bigint id.
+
+    New rows get an id from the column default while the existing ones are
+    numbered in batches, the unique indexes are built concurrently and the
+    primary key is swapped onto the id index at the end. Only the file_size
+    type change rewrites the table under a lock.
+    """
+    columns = dict(
+        conn.execute(
+            text("SELECT column_name, data_type FROM information_schema.columns WHERE table_name = 'files'")
+        ).all()
+    )
+    if not columns:
+        # New database, initial_schema creates the table in its current form
+        return
+    primary_key = conn.execute(
+        text(
+            "SELECT a.attname FROM pg_index i "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = 'files'::regclass AND i.indisprimary"
+        )
+    ).scalar()
+    if primary_key == "id":
+        return
+    conn.execute(text("ALTER TABLE files ADD COLUMN IF NOT EXISTS id BIGINT"))
+    conn.execute(text("CREATE SEQUENCE IF NOT EXISTS files_id_seq OWNED BY files.id"))
+    conn.execute(text("ALTER TABLE files ALTER COLUMN id SET DEFAULT nextval('files_id_seq')"))
+    while conn.execute(
+        text(
+            "UPDATE files SET id = nextval('files_id_seq') WHERE ctid = ANY(ARRAY("
+            "SELECT ctid FROM files WHERE id IS NULL LIMIT :limit))"
+        ),
+        {"limit": batch_size},
+    ).rowcount:
+        pass
+    if columns.get("file_size") != "bigint":
+        conn.execute(text("ALTER TABLE files ALTER COLUMN file_size TYPE BIGINT USING file_size::bigint"))
+    # The same Telegram file saved under two names, keep the first one
+    conn.execute(text("DELETE FROM files a USING files b WHERE a.file_id = b.file_id AND a.id > b.id"))
+    # A concurrent build that failed leaves an invalid index behind, IF NOT EXISTS would keep it
+    conn.execute(
+        text(
+            "DO $$ DECLARE r record; BEGIN "
+            "FOR r IN SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indrelid = 'files'::regclass AND NOT i.indisvalid LOOP "
+            "EXECUTE format('DROP INDEX %I', r.relname); END LOOP; END $$"
+        )
+    )
+    conn.execute(text("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS files_id_key ON files (id)"))
+    conn.execute(text("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_files_file_id ON files (file_id)"))
+    conn.execute(
+        text(
+            "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_files_file_name_file_size "
+            "ON files (file_name, file_size)"
+        )
+    )
+    # A validated check lets SET NOT NULL skip its own full scan under the exclusive lock
+    conn.execute(text("ALTER TABLE files DROP CONSTRAINT IF EXISTS files_id_not_null"))
+    conn.execute(text("ALTER TABLE files ADD CONSTRAINT files_id_not_null CHECK (id IS NOT NULL) NOT VALID"))
+    conn.execute(text("ALTER TABLE files VALIDATE CONSTRAINT files_id_not_null"))
+    conn.execute(text("ALTER TABLE files ALTER COLUMN id SET NOT NULL"))
+    conn.execute(text("ALTER TABLE files DROP CONSTRAINT files_id_not_null"))
+    conn.execute(
+        text(
+            "DO $$ BEGIN "
+            "ALTER TABLE files DROP CONSTRAINT files_pkey; "
+            "ALTER TABLE files ADD CONSTRAINT files_pkey PRIMARY KEY USING INDEX files_id_key; "
+            "END $$"
+        )
+    )
+
+
+def backfill_search_keys(conn, batch_size=1000):
+    """Fill search_name / search_caption of files saved before the columns existed."""
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT id, file_name, caption FROM files WHERE search_name IS NULL LIMIT :limit"
+            ),
+            {"limit": batch_size},
+        ).all()
+        if not rows:
+            return
+        conn.execute(
+            text(
+                "UPDATE files SET search_name = :search_name, search_caption = :search_caption "
+                "WHERE id = :id"
+            ),
+            [
+                {
+                    "id": file_id,
+                    "search_name": normalize(file_name),
+                    "search_caption": normalize(caption),
+                }
+                for file_id, file_name, caption in rows
+            ],
+        )
+
+
+# Versioned schema changes, applied in list order by `python -m mfinder migrate`.
+# Each migration is a list of SQL statements or callables taking the
+# connection, runs once (in its own transaction unless it is Online) and is
+# recorded by name in schema_migrations. Statements should stay idempotent,
+# databases set up before schema_migrations existed replay them.
+MIGRATIONS = [
+    # Before initial_schema: the new file_tokens table references files.id
+    ("files_surrogate_key", Online([add_surrogate_key])),
+    ("initial_schema", [create_tables]),
+    (
+        "files_search_keys",
+        [
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS search_name TEXT",
+            "ALTER TABLE files ADD COLUMN IF NOT EXISTS search_caption TEXT",
+            backfill_search_keys,
+        ],
+    ),
+    (
+        # Named after the text search configuration: changing FTS_CONFIG adds a
+        # pending migration that regenerates the column with the new one
+        f"files_search_vector_{FTS_CONFIG}",
+        [
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'files' "
+            "AND column_name = 'search_vector' "
+            f"AND generation_expression LIKE '%''{FTS_CONFIG}''::regconfig%') THEN "
+            "ALTER TABLE files DROP COLUMN IF EXISTS search_vector; "
+            f"ALTER TABLE files ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_SQL}) STORED; "
+            "END IF; END $$",
+            "CREATE INDEX IF NOT EXISTS ix_files_search_vector ON files USING gin (search_vector)",
+        ],
+    ),
+    (
+        # Fill the precise search token index and the ranking document
+        # frequencies from the normalized search keys of the existing files
+        "file_tokens_backfill",
+        [
+            "DELETE FROM file_tokens",
+            "INSERT INTO file_tokens (token, file_pk) "
+            "SELECT DISTINCT t.token, f.id FROM files f, "
+            "unnest(string_to_array(coalesce(f.search_name, '') || ' ' || coalesce(f.search_caption, ''), ' ')) AS t(token) "
+            "WHERE t.token <> ''",
+            "DELETE FROM term_stats",
+            "INSERT INTO term_stats (token, doc_freq) "
+            "SELECT token, count(*) FROM file_tokens GROUP BY token",
+        ],
+    ),
+    ("index_checkpoints", [create_tables]),
+]
+
+# Trigram indexes let the "%word%" ILIKE filters of the trgm engine use an
+# index. They need the pg_trgm extension, so only set them up when asked for.
+if SEARCH_ENGINE == "trgm":
+    MIGRATIONS.append(
+        (
+            "files_trgm_indexes",
+            [
+                "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+                "CREATE INDEX IF NOT EXISTS ix_files_search_name_trgm ON files USING gin (search_name gin_trgm_ops)",
+                "CREATE INDEX IF NOT EXISTS ix_files_search_caption_trgm ON files USING gin (search_caption gin_trgm_ops)",
+            ],
+        )
+    )
+
+
+def run_steps(conn, statements):
+    for statement in statements:
+        if callable(statement):
+            statement(conn)
+        else:
+            conn.execute(text(statement))
+
+
+def run_migrations(engine):
+    """Apply pending schema changes, each migration in its own transaction.
+
+    Stops at the first failing migration, later ones may depend on it.
+    """
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations "
+                "(name TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        )
+        applied = set(conn.execute(text("SELECT name FROM schema_migrations")).scalars())
+    for name, statements in MIGRATIONS:
+        if name in applied:
+            continue
+        try:
+            if isinstance(statements, Online):
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    run_steps(conn, statements)
+            with engine.begin() as conn:
+                if not isinstance(statements, Online):
+                    run_steps(conn, statements)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                    {"name": name},
+                )
+            LOGGER.info("Applied migration %s", name)
+        except Exception as e:
+            LOGGER.error("Migration %s failed: %s", name, str(e))
+            raise
+
+
+def migrate():
+    """Bring the database schema up to date. Run before starting the bot."""
+    # DDL only, a single sync connection outside the bot's pool is enough
+    engine = create_engine(DB_URL, connect_args={"sslmode": "require"}, poolclass=NullPool)
+    try:
+        run_migrations(engine)
+    finally:
+        engine.dispose()
@@ -1,12 +1,9 @@
-import threading
-from sqlalchemy import create_engine, Column, TEXT, Boolean, Numeric, BigInteger
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import QueuePool
-from sqlalchemy.orm.exc import NoResultFound
-from mfinder import DB_URL, LOGGER
-
-BASE = declarative_base()
+import asyncio
+from sqlalchemy import select, Column, TEXT, Boolean, Numeric, BigInteger
+from sqlalchemy.dialects.postgresql import insert
+from mfinder import LOGGER, USER_SETTINGS_CACHE_SIZE, USER_SETTINGS_CACHE_TTL
+from mfinder.db.database import BASE, SESSION
+from mfinder.utils.cache import TTLCache
 
 class AdminSettings(BASE):
     __tablename__ = "admin_settings"
@@ -42,203 +39,169 @@ class Settings(BASE):
         self.link_mode = link_mode
         self.list_mode = list_mode
 
-def start() -> scoped_session:
-    engine = create_engine(
-        DB_URL,
-        connect_args={"sslmode": "require"},
-        poolclass=QueuePool,
-        pool_size=10,
-        max_overflow=20,
-        pool_pre_ping=True,
-        pool_recycle=1800  # Recycle connections every 1800 seconds (30 minutes)
-    )
-    BASE.metadata.bind = engine
-    BASE.metadata.create_all(engine)
-    return scoped_session(sessionmaker(bind=engine, autoflush=False))
-
-SESSION = start()
-INSERTION_LOCK = threading.RLock()
+# Serializes the read-then-insert writes below so two of them can't both create the same row
+INSERTION_LOCK = asyncio.Lock()
+
+# Snapshot of the admin settings row, read on every search. Only the setters
+# below write the row, each one replaces the snapshot once it committed.
+_ADMIN_SETTINGS = None
+
+def cache_admin_settings(admin_setting):
+    """Replace the snapshot, None drops it and the next read reloads the row."""
+    global _ADMIN_SETTINGS
+    _ADMIN_SETTINGS = admin_setting
+
+# user_id -> Settings row, or None for users without one so they don't query
+# again either. change_search_settings writes every change through.
+USER_SETTINGS_CACHE = TTLCache(maxsize=USER_SETTINGS_CACHE_SIZE, ttl=USER_SETTINGS_CACHE_TTL)
+_MISSING = object()
+
+async def admin_settings_row(session):
+    """Return the admin settings row, creating the default one on first use."""
+    admin_setting = (await session.scalars(select(AdminSettings))).first()
+    if not admin_setting:
+        admin_setting = AdminSettings(setting_name="default")
+        session.add(admin_setting)
+        await session.commit()
+    return admin_setting
 
 async def get_search_settings(user_id):
+    settings = USER_SETTINGS_CACHE.get(user_id, _MISSING)
+    if settings is not _MISSING:
+        return settings
     try:
-        with INSERTION_LOCK:
-            settings = SESSION.query(Settings).filter_by(user_id=user_id).first()
-            return settings
+        async with SESSION() as session:
+            settings = (await session.scalars(select(Settings).filter_by(user_id=user_id))).first()
     except Exception as e:
         LOGGER.warning("Error getting search settings: %s", str(e))
         return None
-    finally:
-        SESSION.close()
+    USER_SETTINGS_CACHE.set(user_id, settings)
+    return settings
 
 async def change_search_settings(user_id, precise_mode=None, button_mode=None, link_mode=None, list_mode=None):
+    """Create or update the settings of a user in one statement, only the
+    given modes change on an existing row."""
+    values = {
+        "precise_mode": precise_mode,
+        "button_mode": button_mode,
+        "link_mode": link_mode,
+        "list_mode": list_mode,
+    }
+    stmt = insert(Settings).values(user_id=user_id, **values)
+    # An update that sets nothing would return no row, rewrite user_id instead
+    changed = {name: stmt.excluded[name] for name, value in values.items() if value is not None}
     try:
-        with INSERTION_LOCK:
-            settings = SESSION.query(Settings).filter_by(user_id=user_id).first()
-            if settings:
-                if precise_mode is not None:
-                    settings.precise_mode = precise_mode
-                if button_mode is not None:
-                    settings.button_mode = button_mode
-                if link_mode is not None:
-                    settings.link_mode = link_mode
-                if list_mode is not None:
-                    settings.list_mode = list_mode
-            else:
-                new_settings = Settings(
-                    user_id=user_id, precise_mode=precise_mode, button_mode=button_mode, link_mode=link_mode, list_mode=list_mode
+        async with SESSION() as session:
+            settings = (
+                await session.scalars(
+                    stmt.on_conflict_do_update(
+                        index_elements=[Settings.user_id],
+                        set_=changed or {"user_id": stmt.excluded.user_id},
+                    )
+                    .returning(Settings)
+                    .execution_options(populate_existing=True)
                 )
-                SESSION.add(new_settings)
-            SESSION.commit()
-            return True
+            ).one()
+            await session.commit()
+        USER_SETTINGS_CACHE.set(user_id, settings)
+        return True
     except Exception as e:
+        USER_SETTINGS_CACHE.pop(user_id)
         LOGGER.warning("Error changing search settings: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def set_repair_mode(repair_mode):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings(setting_name="default")
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.repair_mode = repair_mode
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.repair_mode = repair_mode
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error setting repair mode: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def set_auto_delete(dur):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings(setting_name="default")
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.auto_delete = dur
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.auto_delete = dur
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error setting auto delete: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def get_admin_settings():
+    """The admin settings row, from the snapshot once it was read."""
+    if _ADMIN_SETTINGS is not None:
+        return _ADMIN_SETTINGS
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings(setting_name="default")
-                session.add(admin_setting)
-                session.commit()
-
-            return admin_setting
+        async with INSERTION_LOCK:
+            if _ADMIN_SETTINGS is None:
+                async with SESSION() as session:
+                    cache_admin_settings(await admin_settings_row(session))
+        return _ADMIN_SETTINGS
     except Exception as e:
         LOGGER.warning("Error getting admin settings: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def set_custom_caption(caption):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings(setting_name="default")
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.custom_caption = caption
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.custom_caption = caption
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error setting custom caption: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def set_force_sub(channel):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings.setting_name="default"
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.fsub_channel = channel
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.fsub_channel = channel
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error setting Force Sub channel: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def set_channel_link(link):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings.setting_name="default"
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.channel_link = link
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.channel_link = link
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error adding Force Sub channel link: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
 
 async def get_channel():
-    try:
-        channel = SESSION.query(AdminSettings.fsub_channel).first()
-        if channel:
-            return channel[0]
-        return False
-    except NoResultFound:
-        return False
-    finally:
-        SESSION.close()
+    admin_setting = await get_admin_settings()
+    if admin_setting:
+        return admin_setting.fsub_channel
+    return False
 
 async def get_link():
-    try:
-        link = SESSION.query(AdminSettings.channel_link).first()
-        if link:
-            return link[0]
-        return False
-    except NoResultFound:
-        return False
-    finally:
-        SESSION.close()
+    admin_setting = await get_admin_settings()
+    if admin_setting:
+        return admin_setting.channel_link
+    return False
 
 async def set_username(username):
     try:
-        with INSERTION_LOCK:
-            session = SESSION()
-            admin_setting = session.query(AdminSettings).first()
-            if not admin_setting:
-                admin_setting = AdminSettings.setting_name="default"
-                session.add(admin_setting)
-                session.commit()
-
-            admin_setting.caption_uname = username
-            session.commit()
+        async with INSERTION_LOCK:
+            async with SESSION() as session:
+                admin_setting = await admin_settings_row(session)
+                admin_setting.caption_uname = username
+                await session.commit()
+                cache_admin_settings(admin_setting)
     except Exception as e:
+        cache_admin_settings(None)
         LOGGER.warning("Error adding username: %s", str(e))
-        SESSION.rollback()
-    finally:
-        SESSION.close()
@@ -11,6 +11,9 @@ from mfinder.utils.constants import STARTMSG, HELPMSG
 from mfinder import LOGGER, ADMINS, START_MSG, HELP_MSG, START_KB, HELP_KB
 from mfinder.utils.util_support import humanbytes, get_db_size
 from mfinder.plugins.serve import get_files
+from mfinder.db.files_sql import SEARCH_CACHE
+from mfinder.db.database import pool_stats
+from mfinder.utils.known_files import KNOWN_FILES
 
 
 @Client.on_message(filters.command(["start"]))
@@ -118,9 +121,12 @@ async def server_stats(bot, update):
     cpu_usage = cpu_percent()
     ram_usage = virtual_memory().percent
     used_disk = disk_usage("/").percent
-    db_size = get_db_size()
+    db_size = await get_db_size()
+    pool = pool_stats()
+    cache = SEARCH_CACHE.stats()
+    known = KNOWN_FILES.stats()
 
-    stats_msg = f"--**BOT STATS**--\n`Ping: {ping}`\n\n--**SERVER DETAILS**--\n`Disk Total/Used/Free: {total}/{used}/{free}\nDisk usage: {used_disk}%\nRAM Total/Used/Free: {t_ram}/{u_ram}/{f_ram}\nRAM Usage: {ram_usage}%\nCPU Usage: {cpu_usage}%`\n\n--**DATABASE DETAILS**--\n`Size: {db_size} MB`"
+    stats_msg = f"--**BOT STATS**--\n`Ping: {ping}`\n\n--**SERVER DETAILS**--\n`Disk Total/Used/Free: {total}/{used}/{free}\nDisk usage: {used_disk}%\nRAM Total/Used/Free: {t_ram}/{u_ram}/{f_ram}\nRAM Usage: {ram_usage}%\nCPU Usage: {cpu_usage}%`\n\n--**DATABASE DETAILS**--\n`Size: {db_size} MB\nPool in use/idle/size: {pool['checked_out']}/{pool['checked_in']}/{pool['size']}+{pool['max_overflow']}`\n\n--**SEARCH CACHE**--\n`Entries: {cache['size']}/{cache['maxsize']}\nHits/Misses: {cache['hits']}/{cache['misses']}\nHit rate: {cache['hit_rate']:.1%}`\n\n--**DUPLICATE FILTER**--\n`Keys: {known['keys']}{'' if known['loaded'] else ' (loading)'}\nMemory: {humanbytes(known['memory'])}\nFalse positive rate: {known['false_positive_rate']:.1e}\nSkipped/Lookups: {known['hits']}/{known['lookups']}`"
     try:
         await sts.edit(stats_msg)
     except Exception as e:
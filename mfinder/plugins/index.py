@@ -1,90 +1,128 @@
-import asyncio
 from pyrogram import Client, filters
-from pyrogram.errors import FloodWait
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from mfinder import ADMINS, LOGGER
-from mfinder.db.files_sql import save_file, delete_file
-from mfinder.utils.helpers import edit_caption
-
-lock = asyncio.Lock()
+from mfinder.db.files_sql import delete_file
+from mfinder.db.index_sql import get_checkpoint, unfinished_checkpoints
+from mfinder.utils.indexer import Indexer, INDEX_JOBS, rate
 media_filter = filters.document | filters.video | filters.audio
 
 @Client.on_message(filters.private & filters.user(ADMINS) & media_filter)
 async def index_files(bot, message):
     user_id = message.from_user.id
-    if lock.locked():
-        await message.reply("Wait until previous process complete.")
+    chat_id = message.forward_from_chat.id if message.forward_from_chat else None
+    if chat_id in INDEX_JOBS:
+        await message.reply("This channel is already being indexed, see /indexjobs.")
     else:
         try:
             last_msg_id = message.forward_from_message_id
-            chat_id = message.forward_from_chat.username or message.forward_from_chat.id
             await bot.get_messages(chat_id, last_msg_id)
 
-            kb = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("Proceed", callback_data=f"index {chat_id} {last_msg_id}")],
-                    [InlineKeyboardButton("Cancel", callback_data="can-index")],
+            checkpoint = await get_checkpoint(chat_id)
+            if checkpoint and checkpoint.indexed_to >= 2:
+                buttons = [
+                    [InlineKeyboardButton(
+                        f"Index from message {checkpoint.indexed_to + 1}",
+                        callback_data=f"index {chat_id} {last_msg_id} new",
+                    )],
+                    [InlineKeyboardButton("Full reindex", callback_data=f"index {chat_id} {last_msg_id} full")],
                 ]
-            )
-            await bot.send_message(user_id, "Please confirm if you want to start indexing", reply_markup=kb)
+                text = f"This channel is indexed up to message {checkpoint.indexed_to}, index only the messages after it?"
+            else:
+                buttons = [[InlineKeyboardButton("Proceed", callback_data=f"index {chat_id} {last_msg_id} full")]]
+                text = "Please confirm if you want to start indexing"
+            buttons.append([InlineKeyboardButton("Cancel", callback_data="can-index")])
+            await bot.send_message(user_id, text, reply_markup=InlineKeyboardMarkup(buttons))
         except Exception as e:
             await message.reply_text(f"Unable to start indexing. Error: <code>{e}</code>")
 
 @Client.on_callback_query(filters.regex(r"^index -?\d+ \d+"))
 async def index(bot, query):
     user_id = query.from_user.id
-    chat_id, last_msg_id = map(int, query.data.split()[1:])
+    data = query.data.split()
+    chat_id, last_msg_id = int(data[1]), int(data[2])
+    mode = data[3] if len(data) > 3 else "full"
     await query.message.delete()
-    msg = await bot.send_message(user_id, "Processing Index...⏳")
-    total_files = 0
-    async with lock:
-        try:
-            total = last_msg_id + 1
-            current = 2
-            counter = 0
-            while True:
-                try:
-                    message = await bot.get_messages(chat_id=chat_id, message_ids=current, replies=0)
-                except FloodWait as e:
-                    LOGGER.warning("FloodWait while indexing, Error: %s", str(e))
-                    await asyncio.sleep(e.value)
-                except Exception as e:
-                    LOGGER.warning("Error occurred while fetching message: %s", str(e))
-                try:
-                    for file_type in ("document", "video", "audio"):
-                        media = getattr(message, file_type, None)
-                        if not media:
-                            break
-                        file_name = media.file_name
-                        file_name = edit_caption(file_name)
-                        media.file_type = file_type
-                        media.caption = file_name
-                        await save_file(media)
-                        total_files += 1
-                except Exception as e:
-                    LOGGER.warning("Error occurred while saving file: %s", str(e))
+    first_id = 2
+    if mode == "new":
+        checkpoint = await get_checkpoint(chat_id)
+        if checkpoint:
+            first_id = max(first_id, checkpoint.indexed_to + 1)
+        if first_id > last_msg_id:
+            await bot.send_message(user_id, f"Nothing new to index, already indexed up to message {first_id - 1}.")
+            return
+    if chat_id in INDEX_JOBS:
+        await bot.send_message(user_id, "This channel is already being indexed, see /indexjobs.")
+        return
+    msg = await bot.send_message(user_id, f"Indexing from message {first_id} queued...⏳")
 
-                current += 1
-                counter += 1
-                if counter == 50:
-                    try:
-                        await msg.edit(f"Total messages fetched: {current}\nTotal messages saved: {total_files}")
-                    except FloodWait as e:
-                        LOGGER.warning("FloodWait while indexing, sleeping for: %s", str(e.value))
-                        await asyncio.sleep(e.value)
-                    counter -= 50
-                if current == total:
-                    break
-        except Exception as e:
-            LOGGER.exception(e)
-            await msg.edit(f"Error: {e}")
-        else:
-            await msg.edit(f"Total {total_files} Saved To DataBase!")
+    async def progress(indexer):
+        await msg.edit(indexer.progress())
+
+    async def finish(indexer):
+        summary = (
+            f"Total {indexer.saved} Saved To DataBase!\n"
+            f"Duplicates skipped: {indexer.duplicates}\nSkipped without a name: {indexer.skipped}\n"
+            f"Errors: {indexer.errors}"
+        )
+        if indexer.status == "cancelled":
+            summary = f"Indexing cancelled at message {indexer.indexed_to}, use /resumeindex to continue.\n{summary}"
+        elif indexer.status == "failed":
+            summary = f"Indexing failed at message {indexer.indexed_to}, check logs for more info.\n{summary}"
+        await msg.edit(summary)
+
+    # Another admin may have started this channel while the message was sent
+    if not INDEX_JOBS.start(Indexer(bot, chat_id, first_id, last_msg_id), on_progress=progress, on_finish=finish):
+        await msg.edit("This channel is already being indexed, see /indexjobs.")
+
+@Client.on_message(filters.command(["indexjobs"]) & filters.user(ADMINS))
+async def index_jobs(bot, update):
+    jobs = INDEX_JOBS.list_jobs()
+    if not jobs:
+        await update.reply("No indexing running.")
+        return
+    lines = []
+    buttons = []
+    for indexer in jobs:
+        done = indexer.indexed_to - indexer.first_id + 1
+        total = indexer.last_id - indexer.first_id + 1
+        lines.append(
+            f"`{indexer.chat_id}` - __{indexer.status}__ - {max(done, 0)}/{total} messages, "
+            f"{indexer.saved} saved, {rate(indexer.fetched, indexer.fetch_time):.0f} msg/s"
+        )
+        buttons.append(
+            [InlineKeyboardButton(f"Cancel {indexer.chat_id}", callback_data=f"stop-index {indexer.chat_id}")]
+        )
+    await update.reply("\n".join(lines), reply_markup=InlineKeyboardMarkup(buttons))
+
+@Client.on_callback_query(filters.regex(r"^stop-index -?\d+$") & filters.user(ADMINS))
+async def stop_index(bot, query):
+    chat_id = int(query.data.split()[1])
+    if INDEX_JOBS.cancel(chat_id):
+        await query.answer("Cancelling, progress so far is kept.", show_alert=True)
+    else:
+        await query.answer("This indexing already finished.", show_alert=True)
+    await query.message.delete()
 
 @Client.on_message(filters.command(["index"]) & filters.user(ADMINS))
 async def index_comm(bot, update):
     await update.reply("Now please forward the last message of the channel you want to index & follow the steps. Bot must be admin of the channel if the channel is private.")
 
+@Client.on_message(filters.command(["resumeindex"]) & filters.user(ADMINS))
+async def resume_index(bot, update):
+    checkpoints = await unfinished_checkpoints()
+    if not checkpoints:
+        await update.reply("No unfinished indexing to resume.")
+        return
+    buttons = [
+        [InlineKeyboardButton(
+            f"{checkpoint.chat_id}: {checkpoint.indexed_to}/{checkpoint.last_msg_id}",
+            callback_data=f"index {checkpoint.chat_id} {checkpoint.last_msg_id} new",
+        )]
+        for checkpoint in checkpoints
+    ]
+    buttons.append([InlineKeyboardButton("Cancel", callback_data="can-index")])
+    await update.reply("Select the indexing to resume:", reply_markup=InlineKeyboardMarkup(buttons))
+
 @Client.on_message(filters.command(["delete"]) & filters.user(ADMINS))
 async def delete_files(bot, message):
     if not message.reply_to_message:
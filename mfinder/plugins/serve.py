@@ -1,4 +1,5 @@
 import re
+import secrets
 import asyncio
 from pyrogram import Client, filters
 from pyrogram.types import (
@@ -12,9 +13,9 @@ from pyrogram.enums import ParseMode, ChatMemberStatus
 from pyrogram.errors import UserNotParticipant
 from pyrogram.errors.exceptions.bad_request_400 import MessageNotModified
 from mfinder.db.files_sql import (
-    get_filter_results,
+    search_files,
     get_file_details,
-    get_precise_filter_results,
+    get_files_by_ids,
 )
 from mfinder.db.settings_sql import (
     get_search_settings,
@@ -24,8 +25,54 @@ from mfinder.db.settings_sql import (
 )
 from mfinder.db.ban_sql import is_banned
 from mfinder.db.filters_sql import is_filter
-from mfinder import LOGGER
+from mfinder import LOGGER, SEARCH_SESSION_SIZE, SEARCH_SESSION_TTL, SEARCH_SESSION_RESULTS
 from mfinder.utils.helpers import shorten_url
+from mfinder.utils.cache import TTLCache
+from mfinder.utils.spelling import SPELLER
+
+
+class SearchSession:
+    """Ordered result ids of one search, referenced from page buttons by token.
+
+    Only the first SEARCH_SESSION_RESULTS ids are kept, pages past them are
+    queried by seeking from the last sort key of the neighbouring page. They
+    are ranked with the idf weights of the first query, so the sort keys
+    stay comparable while files are saved or deleted.
+    """
+
+    def __init__(self, query, precise, rows, total, weights, per_page=10):
+        self.token = secrets.token_urlsafe(6)
+        self.query = query
+        self.precise = precise
+        self.ids = [file_id for file_id, _ in rows]
+        self.keys = [sort_key for _, sort_key in rows]
+        self.total = total
+        self.weights = weights
+        self.per_page = per_page
+        # page -> (first sort_key, last sort_key) of pages fetched past the stored ids
+        self.cursors = {}
+
+    def page_keys(self, page_no):
+        if page_no in self.cursors:
+            return self.cursors[page_no]
+        start = (page_no - 1) * self.per_page
+        if 0 <= start < len(self.keys):
+            return self.keys[start], self.keys[min(start + self.per_page, len(self.keys)) - 1]
+        return None
+
+    def get_cursor(self, page_no):
+        """Return (after, before) keys for page_no from the adjacent page, if it is known."""
+        prev_page = self.page_keys(page_no - 1)
+        if prev_page:
+            return prev_page[1], None
+        next_page = self.page_keys(page_no + 1)
+        if next_page:
+            return None, next_page[0]
+        return None, None
+
+
+# token -> SearchSession, expires with the result message (deleted after 15 minutes)
+SEARCH_SESSIONS = TTLCache(maxsize=SEARCH_SESSION_SIZE, ttl=SEARCH_SESSION_TTL)
 
 @Client.on_message(
     ~filters.regex(r"^\/") & filters.text & filters.private & filters.incoming
@@ -85,6 +132,15 @@ async def filter_(bot, message):
         me = bot.me
         username = me.username
         result, btn = await get_result(search, page_no, user_id, username)
+        if not result:
+            suggestion = SPELLER.correct(search)
+            if suggestion:
+                result, btn = await get_result(suggestion, page_no, user_id, username)
+                if result:
+                    result = (
+                        f"__No results for__ `{search}`, __showing results for__ `{suggestion}`\n\n"
+                        + result
+                    )
 
         if result:
             if btn:
@@ -112,13 +168,20 @@ async def filter_(bot, message):
 @Client.on_callback_query(filters.regex(r"^(nxt_pg|prev_pg) \d+ \d+ .+$"))
 async def pages(bot, query):
     user_id = query.from_user.id
-    org_user_id, page_no, search = query.data.split(maxsplit=3)[1:]
+    org_user_id, page_no, token = query.data.split(maxsplit=3)[1:]
     org_user_id = int(org_user_id)
     page_no = int(page_no)
     me = bot.me
     username = me.username
 
-    result, btn = await get_result(search, page_no, user_id, username)
+    session = SEARCH_SESSIONS.get(token)
+    if session is None:
+        await query.answer(
+            "This search has expired, please send your query again.", show_alert=True
+        )
+        return
+
+    result, btn = await get_result(session.query, page_no, user_id, username, session)
 
     if result:
         try:
@@ -143,17 +206,40 @@ async def pages(bot, query):
             quote=True,
         )
 
-async def get_result(search, page_no, user_id, username):
+async def new_search_session(search, precise):
+    """Start a search session, return it and the files of its first page."""
+    files, total, rows, weights = await search_files(search, precise, limit=SEARCH_SESSION_RESULTS)
+    session = SearchSession(search, precise, rows, total, weights)
+    if rows:
+        SEARCH_SESSIONS.set(session.token, session)
+    return session, files
+
+async def get_session_page(session, page_no):
+    start = (page_no - 1) * session.per_page
+    if start < len(session.ids):
+        files = await get_files_by_ids(session.ids[start:start + session.per_page])
+    else:
+        after, before = session.get_cursor(page_no)
+        files, _, _, _ = await search_files(
+            session.query, session.precise, page=page_no, after=after, before=before, weights=session.weights
+        )
+        if files:
+            session.cursors[page_no] = (files[0].sort_key, files[-1].sort_key)
+    return files, session.total
+
+async def get_result(search, page_no, user_id, username, session=None):
     search_settings = await get_search_settings(user_id)
-    if search_settings:
-        if search_settings.precise_mode:
-            files, count = await get_precise_filter_results(query=search, page=page_no)
-            precise_search = "Enabled"
-        else:
-            files, count = await get_filter_results(query=search, page=page_no)
-            precise_search = "Disabled"
+    first_page = None
+    if session is None:
+        precise = bool(search_settings and search_settings.precise_mode)
+        session, first_page = await new_search_session(search, precise)
+    if first_page is not None and page_no == 1:
+        files, count = first_page, session.total
+    else:
+        files, count = await get_session_page(session, page_no)
+    if session.precise:
+        precise_search = "Enabled"
     else:
-        files, count = await get_filter_results(query=search, page=page_no)
         precise_search = "Disabled"
 
     if search_settings:
@@ -227,11 +313,11 @@ async def get_result(search, page_no, user_id, username):
 
         nxt_kb = InlineKeyboardButton(
             text="Next >>",
-            callback_data=f"nxt_pg {user_id} {page + 1} {search}",
+            callback_data=f"nxt_pg {user_id} {page + 1} {session.token}",
         )
         prev_kb = InlineKeyboardButton(
             text="<< Previous",
-            callback_data=f"prev_pg {user_id} {page - 1} {search}",
+            callback_data=f"prev_pg {user_id} {page - 1} {session.token}",
         )
 
         kb = []
@@ -1,5 +1,7 @@
 from typing import Union
+import re
 import base64
+import unicodedata
 from struct import pack
 from pyrogram import raw
 from pyrogram.file_id import FileId, FileType, PHOTO_TYPES, DOCUMENT_TYPES
@@ -84,6 +86,27 @@ def unpack_new_file_id(new_file_id):
 def edit_caption(c_caption):
     return c_caption
 
+# Word separators in file names and captions: whitespace, ".", "_", "-" and brackets
+SEPARATORS = re.compile(r"[\s._\-\[\](){}]+")
+
+def normalize(text):
+    """Return the search key form of text.
+
+    Accents are stripped, case is folded and separators become single
+    spaces, so "Movie.Name_2023" and "Movié Name 2023" give the same key.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return SEPARATORS.sub(" ", text.casefold()).strip()
+
+def tokenize(text):
+    """Return the set of lowercased, space separated words in text (precise search terms)."""
+    if not text:
+        return set()
+    return {word for word in text.lower().split(" ") if word}
+
 import os
 import requests
 
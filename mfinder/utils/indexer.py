@@ -0,0 +1,348 @@
+import asyncio
+import time
+from collections import deque
+from pyrogram.errors import FloodWait
+from mfinder import (
+    LOGGER,
+    INDEX_CONCURRENCY,
+    LIVE_INDEX_DELAY,
+    LIVE_INDEX_BATCH,
+    LIVE_INDEX_MAX_PENDING,
+)
+from mfinder.db.files_sql import save_files
+from mfinder.db.index_sql import set_checkpoint
+from mfinder.utils.helpers import edit_caption
+
+# Message ids requested per get_messages call, 200 is the Telegram maximum
+FETCH_BATCH_SIZE = 200
+# Files written per save_files call
+SAVE_BATCH_SIZE = 100
+# Fetched ranges waiting to be saved, fetching pauses while the queue is full
+QUEUE_SIZE = 10
+# Tasks draining the queue into the database
+PERSIST_WORKERS = 2
+# Seconds between two progress reports
+PROGRESS_INTERVAL = 10
+# Attempts at fetching a range or saving a batch, and the seconds before the
+# first retry, doubled for each further one
+RETRIES = 4
+RETRY_DELAY = 2
+
+
+def get_media(message):
+    """Return (file_type, media) of the document, video or audio in message, or (None, None)."""
+    for file_type in ("document", "video", "audio"):
+        media = getattr(message, file_type, None)
+        if media:
+            return file_type, media
+    return None, None
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else 0.0
+
+
+class Indexer:
+    """Index the media of message ids first_id..last_id of a chat.
+
+    A fetch stage pulls ranges of messages from Telegram and puts their media
+    on a bounded queue, PERSIST_WORKERS persist stages drain it into the
+    database in batches. Fetching and saving overlap; when the database falls
+    behind, the full queue pauses fetching.
+
+    Writers finish ranges out of order, so the checkpoint only advances over
+    the leading run of saved ranges: after a crash, resuming from indexed_to
+    never skips a message.
+    """
+
+    def __init__(self, bot, chat_id, first_id, last_id):
+        # queued, running, done, cancelled or failed, set by IndexJobs
+        self.status = "queued"
+        self.started = None
+        self.bot = bot
+        self.chat_id = chat_id
+        self.first_id = first_id
+        self.last_id = last_id
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        # Messages fetched and seconds spent waiting on Telegram
+        self.fetched = 0
+        self.fetch_time = 0.0
+        # Files written and seconds spent waiting on the database
+        self.saved = 0
+        self.duplicates = 0
+        # Media without a file name or caption, nothing to search them by
+        self.skipped = 0
+        # Files of batches the database refused
+        self.errors = 0
+        self.save_time = 0.0
+        # Last ids of fetched ranges in fetch order, and those already saved
+        self.in_flight = deque()
+        self.done = set()
+        self.indexed_to = first_id - 1
+
+    async def run(self, on_progress=None):
+        """Index the whole range, calling on_progress(indexer) every PROGRESS_INTERVAL seconds."""
+        await set_checkpoint(self.chat_id, self.indexed_to, self.last_id)
+        writers = [asyncio.create_task(self.persist()) for _ in range(PERSIST_WORKERS)]
+        reporter = asyncio.create_task(self.report(on_progress)) if on_progress else None
+        try:
+            await self.fetch()
+            for _ in writers:
+                await self.queue.put(None)
+            await asyncio.gather(*writers)
+        finally:
+            for task in writers + [reporter]:
+                if task and not task.done():
+                    task.cancel()
+
+    async def fetch(self):
+        current = self.first_id
+        attempt = 0
+        while current <= self.last_id:
+            message_ids = list(range(current, min(current + FETCH_BATCH_SIZE, self.last_id + 1)))
+            started = time.monotonic()
+            try:
+                messages = await self.bot.get_messages(chat_id=self.chat_id, message_ids=message_ids, replies=0)
+            except FloodWait as e:
+                LOGGER.warning("FloodWait while indexing, Error: %s", str(e))
+                await asyncio.sleep(e.value)
+                continue
+            except Exception as e:
+                LOGGER.warning("Error occurred while fetching messages %s-%s: %s", message_ids[0], message_ids[-1], str(e))
+                attempt += 1
+                if attempt < RETRIES:
+                    await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+                    continue
+                # Skipped, and never marked saved: the checkpoint stays before it
+                self.errors += len(message_ids)
+                self.in_flight.append(message_ids[-1])
+                current = message_ids[-1] + 1
+                attempt = 0
+                continue
+            attempt = 0
+            self.fetch_time += time.monotonic() - started
+            self.fetched += len(message_ids)
+            files = []
+            for message in messages:
+                file_type, media = get_media(message)
+                if not media:
+                    continue
+                media.file_type = file_type
+                media.caption = edit_caption(media.file_name)
+                files.append(media)
+            self.in_flight.append(message_ids[-1])
+            await self.queue.put((message_ids[-1], files))
+            current = message_ids[-1] + 1
+
+    async def persist(self):
+        batch = []
+        ranges = []
+        while True:
+            item = await self.queue.get()
+            if item is not None:
+                range_end, files = item
+                ranges.append(range_end)
+                batch.extend(files)
+            if ranges and (item is None or len(batch) >= SAVE_BATCH_SIZE):
+                await self.save(batch, ranges)
+                batch = []
+                ranges = []
+            if item is None:
+                return
+
+    async def save(self, batch, ranges):
+        started = time.monotonic()
+        for attempt in range(RETRIES):
+            try:
+                saved, duplicates, skipped = await save_files(batch) if batch else ([], [], [])
+                break
+            except Exception:
+                if attempt == RETRIES - 1:
+                    # The database kept failing, keep the checkpoint before these ranges
+                    self.errors += len(batch)
+                    self.save_time += time.monotonic() - started
+                    return
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+        self.save_time += time.monotonic() - started
+        self.saved += len(saved)
+        self.duplicates += len(duplicates)
+        self.skipped += len(skipped)
+        self.done.update(ranges)
+        indexed_to = self.indexed_to
+        while self.in_flight and self.in_flight[0] in self.done:
+            indexed_to = self.in_flight.popleft()
+            self.done.discard(indexed_to)
+        if indexed_to != self.indexed_to:
+            self.indexed_to = indexed_to
+            await set_checkpoint(self.chat_id, indexed_to, self.last_id)
+
+    async def report(self, on_progress):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            try:
+                await on_progress(self)
+            except FloodWait as e:
+                LOGGER.warning("FloodWait while indexing, sleeping for: %s", str(e.value))
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                LOGGER.warning("Error occurred while reporting index progress: %s", str(e))
+
+    def progress(self):
+        return (
+            f"Total messages fetched: {self.fetched}\n"
+            f"Total messages saved: {self.saved}\n"
+            f"Duplicates skipped: {self.duplicates}\n"
+            f"Skipped without a name: {self.skipped}\n"
+            f"Errors: {self.errors}\n"
+            f"Indexed up to message: {self.indexed_to}\n"
+            f"Fetch: {rate(self.fetched, self.fetch_time):.0f} msg/s, "
+            f"Save: {rate(self.saved + self.duplicates, self.save_time):.0f} files/s, "
+            f"Queue: {self.queue.qsize()}/{QUEUE_SIZE}"
+        )
+
+
+class IndexJobs:
+    """Indexing jobs by chat id, at most `limit` of them running at once.
+
+    Jobs over the limit wait for a free slot. One job per chat, so two admins
+    can't index the same channel twice in parallel. The limit bounds the
+    database connections (PERSIST_WORKERS per job) and the share of the
+    Telegram rate budget spent on get_messages.
+    """
+
+    def __init__(self, limit):
+        self.slots = asyncio.Semaphore(limit)
+        # chat_id -> (indexer, task)
+        self.jobs = {}
+
+    def __contains__(self, chat_id):
+        return chat_id in self.jobs
+
+    def start(self, indexer, on_progress=None, on_finish=None):
+        """Queue indexer, on_finish(indexer) is awaited once it stopped for any reason.
+
+        Returns None without starting anything if the chat already has a job.
+        Checks and registers without awaiting, so two callers can't both pass.
+        """
+        if indexer.chat_id in self.jobs:
+            return None
+        task = asyncio.create_task(self.run(indexer, on_progress, on_finish))
+        self.jobs[indexer.chat_id] = (indexer, task)
+        return task
+
+    async def run(self, indexer, on_progress, on_finish):
+        try:
+            async with self.slots:
+                indexer.status = "running"
+                indexer.started = time.monotonic()
+                await indexer.run(on_progress)
+            indexer.status = "done"
+        except asyncio.CancelledError:
+            indexer.status = "cancelled"
+        except Exception as e:
+            indexer.status = "failed"
+            LOGGER.exception("Indexing %s failed: %s", indexer.chat_id, str(e))
+        finally:
+            if self.jobs.get(indexer.chat_id, (None,))[0] is indexer:
+                del self.jobs[indexer.chat_id]
+        if on_finish:
+            try:
+                await on_finish(indexer)
+            except Exception as e:
+                LOGGER.warning("Error occurred while reporting index result: %s", str(e))
+
+    def cancel(self, chat_id):
+        job = self.jobs.get(chat_id)
+        if not job:
+            return False
+        job[1].cancel()
+        return True
+
+    def list_jobs(self):
+        return [indexer for indexer, _ in self.jobs.values()]
+
+
+INDEX_JOBS = IndexJobs(INDEX_CONCURRENCY)
+
+
+class LiveIndexBuffer:
+    """Write-behind buffer for posts arriving in DB_CHANNELS.
+
+    Posts are saved batch_size at a time, at the latest `delay` seconds after
+    the first one arrived, so a burst of uploads costs a few inserts instead of
+    one per post. Adding to a full batch waits for it to be saved, which holds
+    back the handlers while the database catches up.
+
+    A batch the database refused stays at the head of the buffer and is tried
+    again after another delay; past max_pending posts the oldest are dropped
+    and logged, the next /index of the channel picks them up.
+    """
+
+    def __init__(self, batch_size, delay, max_pending):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.max_pending = max_pending
+        self.pending = []
+        self.timer = None
+        # Set while a refused batch waits for its retry, full batches wait too
+        self.retrying = False
+        # One flush at a time, batches reach the database in arrival order
+        self.lock = asyncio.Lock()
+
+    async def add(self, media):
+        self.pending.append(media)
+        self.trim()
+        if len(self.pending) >= self.batch_size and not self.retrying:
+            await self.flush()
+        else:
+            self.schedule()
+
+    def schedule(self):
+        if self.timer is None or self.timer.done():
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            LOGGER.warning("Error occurred while saving live indexed files: %s", str(e))
+
+    async def flush(self):
+        """Save everything buffered so far, return False if the database refused a batch."""
+        async with self.lock:
+            while self.pending:
+                batch = self.pending[: self.batch_size]
+                del self.pending[: len(batch)]
+                try:
+                    saved, duplicates, _ = await save_files(batch)
+                except Exception:
+                    self.pending[:0] = batch
+                    self.trim()
+                    self.retrying = True
+                    LOGGER.warning("Could not save %s live indexed files, retrying in %ss", len(batch), self.delay)
+                    self.schedule()
+                    return False
+                self.retrying = False
+                LOGGER.info("Live indexed %s files, %s already saved", len(saved), len(duplicates))
+        return True
+
+    def trim(self):
+        overflow = len(self.pending) - self.max_pending
+        if overflow > 0:
+            for media in self.pending[:overflow]:
+                LOGGER.error("Live index buffer full, dropped %s", media.file_name)
+            del self.pending[:overflow]
+
+    async def close(self):
+        """Cancel the timer and save what is still buffered, called on shutdown."""
+        if self.timer and not self.timer.done():
+            self.timer.cancel()
+        if self.pending and not await self.flush():
+            LOGGER.error("Shutting down with %s live indexed files not saved", len(self.pending))
+        if self.timer and not self.timer.done():
+            self.timer.cancel()
+
+
+LIVE_INDEX = LiveIndexBuffer(LIVE_INDEX_BATCH, LIVE_INDEX_DELAY, LIVE_INDEX_MAX_PENDING)
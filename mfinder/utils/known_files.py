@@ -0,0 +1,111 @@
+import sys
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from itertools import chain
+
+# Keys added since the last merge kept in a set, merged into the sorted array
+# once there are more than this many, or an eighth of the array
+MERGE_MIN = 65536
+
+
+def key_hash(kind, value):
+    return int.from_bytes(blake2b(f"{kind}:{value}".encode(), digest_size=8).digest(), "little")
+
+
+def file_keys(file_id, file_name, file_size):
+    """The two keys save_files treats as a duplicate: file_id and (file_name, file_size)."""
+    return key_hash("id", file_id), key_hash("name", f"{file_name}\0{file_size}")
+
+
+class KnownFiles:
+    """64 bit hashes of the keys of every saved file, to skip duplicates without a query.
+
+    The hashes live in a sorted array of 8 byte integers searched with bisect,
+    plus a set of the ones added since the last merge. Unlike a Bloom filter
+    it supports deletes, and a false positive needs two different keys with
+    the same 64 bit hash, about n / 2**64 per lookup.
+
+    Until the initial load finished nothing is known, every file goes to the
+    database, which stays the authority on duplicates.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.hashes = array("Q")
+        self.recent = set()
+        # Hashes deleted while the initial load was running
+        self.deleted = set()
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.hashes) + len(self.recent)
+
+    def _in_array(self, value):
+        i = bisect_left(self.hashes, value)
+        return i < len(self.hashes) and self.hashes[i] == value
+
+    def known(self, file_id, file_name, file_size):
+        if not self.loaded:
+            return False
+        self.lookups += 1
+        for value in file_keys(file_id, file_name, file_size):
+            if value in self.recent or self._in_array(value):
+                self.hits += 1
+                return True
+        return False
+
+    def add(self, file_id, file_name, file_size):
+        self.recent.update(file_keys(file_id, file_name, file_size))
+        if self.loaded and len(self.recent) > max(MERGE_MIN, len(self.hashes) // 8):
+            self.merge()
+
+    def discard(self, file_id, file_name, file_size):
+        for value in file_keys(file_id, file_name, file_size):
+            self.recent.discard(value)
+            if not self.loaded:
+                self.deleted.add(value)
+                continue
+            i = bisect_left(self.hashes, value)
+            if i < len(self.hashes) and self.hashes[i] == value:
+                del self.hashes[i]
+
+    def extend(self, rows):
+        """Add (file_id, file_name, file_size) rows of the initial load, sorted by finish_loading."""
+        for file_id, file_name, file_size in rows:
+            self.hashes.extend(file_keys(file_id, file_name, file_size))
+
+    def finish_loading(self):
+        self.hashes = array("Q", sorted(set(self.hashes) - self.deleted))
+        self.deleted.clear()
+        self.merge()
+        self.loaded = True
+
+    def abort_loading(self):
+        self.hashes = array("Q")
+        self.deleted.clear()
+
+    def merge(self):
+        if self.recent:
+            self.hashes = array("Q", sorted(set(chain(self.hashes, self.recent))))
+            self.recent.clear()
+
+    def stats(self):
+        size = len(self)
+        return {
+            "loaded": self.loaded,
+            "keys": size,
+            "memory": (
+                self.hashes.itemsize * len(self.hashes)
+                + sys.getsizeof(self.recent)
+                + sys.getsizeof(1 << 63) * len(self.recent)
+            ),
+            # Both keys of a new file are looked up
+            "false_positive_rate": 2 * size / 2**64,
+            "lookups": self.lookups,
+            "hits": self.hits,
+        }
+
+
+KNOWN_FILES = KnownFiles()
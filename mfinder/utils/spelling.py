@@ -0,0 +1,182 @@
+from array import array
+from mfinder import SPELL_MAX_DISTANCE, SPELL_PREFIX_LENGTH
+from mfinder.utils.helpers import normalize
+
+
+def edit_distance(a, b, max_distance):
+    """Optimal string alignment distance of a and b, or max_distance + 1 if it is larger."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev_prev = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(prev[j] + 1, row[j - 1] + 1, prev[j - 1] + cost)
+            if (
+                prev_prev is not None
+                and i > 1
+                and j > 1
+                and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                row[j] = min(row[j], prev_prev[j - 2] + 1)
+        if min(row) > max_distance:
+            return max_distance + 1
+        prev_prev, prev = prev, row
+    return prev[-1]
+
+
+def one_edit_apart(a, b):
+    """True if a and b differ by exactly one insert, delete, substitution or
+    adjacent transposition, edit_distance(a, b) == 1 without the DP table."""
+    if a == b or abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < len(a) and i < len(b) and a[i] == b[i]:
+        i += 1
+    if len(a) > len(b):
+        return a[i + 1:] == b[i:]
+    if len(a) < len(b):
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (
+        a[i + 2:] == b[i + 2:] and a[i:i + 2] == b[i:i + 2][::-1]
+    )
+
+
+class SymSpell:
+    """Symmetric delete spelling corrector over the words of all saved files.
+
+    Every word is stored together with all strings reachable from its prefix
+    by deleting up to max_distance characters. A lookup generates the same
+    deletes for the misspelt word, so finding candidates is a handful of dict
+    hits and never touches the database.
+
+    To stay small, the delete index maps a 30 bit hash of each delete to word
+    numbers instead of strings to sets of words: a single int for most keys,
+    an array("I") for the shared ones. A hash collision only adds a candidate,
+    which the edit distance check then rejects.
+    """
+
+    def __init__(self, max_distance=2, prefix_length=6):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        # word -> number of files containing it
+        self.words = {}
+        # word -> its number, and number -> word (None once removed, reused)
+        self.ids = {}
+        self.vocab = []
+        self.free = []
+        # delete hash -> word number, or array of word numbers
+        self.deletes = {}
+
+    def __len__(self):
+        return len(self.words)
+
+    def _deletes(self, word):
+        key = word[: self.prefix_length]
+        results = {key}
+        edits = {key}
+        for _ in range(self.max_distance):
+            edits = {
+                edit[:i] + edit[i + 1:] for edit in edits for i in range(len(edit))
+            }
+            results |= edits
+        # Small ints are the cheapest dict keys, collisions are rare and harmless
+        return {hash(delete) & 0x3FFFFFFF for delete in results}
+
+    @staticmethod
+    def _indexable(word):
+        # Pure numbers (years, episode numbers, sizes) are never corrected
+        return len(word) > 2 and not word.isdigit()
+
+    def add(self, word, count=1):
+        if not self._indexable(word):
+            return
+        if word in self.words:
+            self.words[word] += count
+            return
+        self.words[word] = count
+        if self.free:
+            number = self.free.pop()
+            self.vocab[number] = word
+        else:
+            number = len(self.vocab)
+            self.vocab.append(word)
+        self.ids[word] = number
+        for delete in self._deletes(word):
+            numbers = self.deletes.get(delete)
+            if numbers is None:
+                self.deletes[delete] = number
+            elif isinstance(numbers, int):
+                self.deletes[delete] = array("I", (numbers, number))
+            else:
+                numbers.append(number)
+
+    def remove(self, word, count=1):
+        if word not in self.words:
+            return
+        self.words[word] -= count
+        if self.words[word] > 0:
+            return
+        del self.words[word]
+        number = self.ids.pop(word)
+        self.vocab[number] = None
+        self.free.append(number)
+        for delete in self._deletes(word):
+            numbers = self.deletes.get(delete)
+            if numbers is None:
+                continue
+            if isinstance(numbers, int):
+                if numbers == number:
+                    del self.deletes[delete]
+                continue
+            if number in numbers:
+                numbers.remove(number)
+            if len(numbers) == 1:
+                self.deletes[delete] = numbers[0]
+
+    def candidates(self, word):
+        numbers = set()
+        for delete in self._deletes(word):
+            found = self.deletes.get(delete)
+            if found is None:
+                continue
+            if isinstance(found, int):
+                numbers.add(found)
+            else:
+                numbers.update(found)
+        return [self.vocab[number] for number in numbers]
+
+    def lookup(self, word):
+        """Return the closest known word (most frequent on ties), word itself if known, or None."""
+        if word in self.words or not self._indexable(word):
+            return word if word in self.words else None
+        # Most frequent first, so the first candidate at the smallest distance wins
+        candidates = sorted(self.candidates(word), key=self.words.__getitem__, reverse=True)
+        # Most typos are one edit away, find those without the DP table
+        if self.max_distance >= 1:
+            for candidate in candidates:
+                if one_edit_apart(word, candidate):
+                    return candidate
+        best, best_distance = None, self.max_distance + 1
+        for candidate in candidates:
+            # Too far apart in length to beat the best so far, skip the DP
+            if abs(len(candidate) - len(word)) >= best_distance:
+                continue
+            distance = edit_distance(word, candidate, best_distance - 1)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    def correct(self, query):
+        """Return query with unknown words replaced by their closest match, or None if nothing changed."""
+        words = normalize(query).split()
+        corrected = [self.lookup(word) or word for word in words]
+        if corrected == words:
+            return None
+        return " ".join(corrected)
+
+
+SPELLER = SymSpell(max_distance=SPELL_MAX_DISTANCE, prefix_length=SPELL_PREFIX_LENGTH)
@@ -1,7 +1,6 @@
-import psycopg2
-from psycopg2 import pool
-from mfinder import ADMINS, DB_URL
-import time
+from sqlalchemy import text
+from mfinder import ADMINS
+from mfinder.db.database import get_engine
 
 def is_admin(user_id):
     return user_id in ADMINS
@@ -25,41 +24,12 @@ def humanbytes(B):
     elif TB <= B:
         return f'{B/TB:.2f} TB'
 
-def get_db_size():
-    conn = psycopg2.connect(DB_URL)
-    cursor = conn.cursor()
-    query = "SELECT pg_database_size(current_database()) / (1024.0 * 1024.0)::numeric;"
-    cursor.execute(query)
-    database_size_mb = cursor.fetchone()[0]
+async def get_db_size():
+    async with get_engine().connect() as conn:
+        database_size_mb = await conn.scalar(
+            text("SELECT pg_database_size(current_database()) / (1024.0 * 1024.0)::numeric;")
+        )
     database_size_mb = float(
         database_size_mb) if database_size_mb is not None else 0.0
     db_size = round(database_size_mb, 2)
-    cursor.close()
-    conn.close()
     return db_size
-
-# Connection Pooling
-connection_pool = pool.SimpleConnectionPool(
-    1, 10, DB_URL
-)
-
-def get_connection_with_retry(retries=5, delay=5):
-    for attempt in range(retries):
-        try:
-            conn = connection_pool.getconn()
-            if conn:
-                return conn
-        except psycopg2.OperationalError:
-            if attempt < retries - 1:
-                time.sleep(delay)
-                continue
-            else:
-                raise
-    raise Exception("Failed to get connection after multiple retries")
-
-def release_connection(conn):
-    if conn:
-        connection_pool.putconn(conn)
-
-def close_all_connections():
-    connection_pool.closeall()